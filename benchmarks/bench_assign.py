@@ -0,0 +1,52 @@
+"""Assignment latency of Task.save_user_task_to_db as a function of the number of assignees.
+
+Mongo is replaced by a collection that sleeps for a fixed round-trip time per request,
+which is what dominates the cost. Run from the repository root: python -m benchmarks.bench_assign
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from commands.task import Task
+
+ROUND_TRIP = 0.002
+
+
+class LatencyCollection:
+    def __init__(self):
+        self.requests = 0
+
+    async def update_one(self, query, update, upsert=False):
+        self.requests += 1
+        await asyncio.sleep(ROUND_TRIP)
+
+    async def bulk_write(self, requests, ordered=True):
+        self.requests += 1
+        await asyncio.sleep(ROUND_TRIP + requests.__len__() * 0.000005)
+
+
+async def one_by_one(t):
+    # the previous implementation: one upsert per assignee
+    for x in t.user_ids:
+        await t.bot.db.users.update_one({'user_id': str(x), 'server_id': str(t.server.id)},
+                                        {'$addToSet': await t.user_task_to_dict()}, upsert=True)
+
+
+async def main():
+    print(f'{"assignees":>10}{"one by one":>14}{"bulk":>12}{"requests":>10}')
+    for n in (1, 10, 100, 1000, 5000):
+        results = []
+        for save in (one_by_one, Task.save_user_task_to_db):
+            bot = SimpleNamespace(db=SimpleNamespace(users=LatencyCollection()))
+            t = Task(bot, load=True)
+            t.server = SimpleNamespace(id=1)
+            t.task_name = 'task'
+            t.user_ids = list(range(n))
+            start = time.perf_counter()
+            await save(t)
+            results.append((time.perf_counter() - start, bot.db.users.requests))
+        print(f'{n:>10}{results[0][0] * 1000:>11.1f} ms{results[1][0] * 1000:>9.1f} ms{results[1][1]:>10}')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,66 @@
+"""Latency and accuracy of utils.deadline_parser against plain dateparser.parse on typical wizard inputs.
+
+Run from the repository root: python -m benchmarks.bench_deadline_parser
+"""
+import asyncio
+import datetime
+import statistics
+import time
+
+import dateparser
+
+from utils.deadline_parser import parse_deadline, parse_fast
+
+CORPUS = [
+    'in 2 days', 'in 3 hours', 'in 45 minutes', 'in 1 week', 'in 2 days CET', 'in 5 hours EST',
+    'tomorrow', 'next week', 'next week CET', 'tomorrow UTC',
+    '2030-05-03', '2030-05-03 14:30', '2030-05-03 14:30 UTC', '2030-12-24T18:00',
+    '13.11.2030', '13.11.2030 9pm EST', '24.12.2030 18:00 CET', '9.11.2030 9pm EST',
+    'may 3rd 2030', 'friday', 'end of month', 'december 24 2030 6pm',
+]
+# results computed from "now" may differ by the time between the two calls
+TOLERANCE = datetime.timedelta(seconds=5)
+
+
+def same(a, b):
+    if a is None or b is None:
+        return a is b
+    if (a.tzinfo is None) != (b.tzinfo is None):
+        return False
+    return abs(a - b) <= TOLERANCE
+
+
+def timed(fn, *args, repeat=20):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        samples.append(time.perf_counter() - start)
+    return result, statistics.median(samples)
+
+
+async def main():
+    matches = 0
+    fast_hits = 0
+    total_old = total_new = 0.0
+    for text in CORPUS:
+        expected, t_old = timed(dateparser.parse, text)
+        start = time.perf_counter()
+        for _ in range(20):
+            result = await parse_deadline(text)
+        t_new = (time.perf_counter() - start) / 20
+        fast = parse_fast(text) is not None
+        fast_hits += fast
+        matches += same(expected, result)
+        total_old += t_old
+        total_new += t_new
+        print(f'{text:<26}{t_old * 1e6:10.0f} us {t_new * 1e6:10.0f} us  '
+              f'{"fast" if fast else "slow"}  {"ok" if same(expected, result) else f"{expected} != {result}"}')
+    print(f'\n{fast_hits}/{CORPUS.__len__()} on the fast path, {matches}/{CORPUS.__len__()} agree with dateparser')
+    print(f'dateparser.parse {total_old / CORPUS.__len__() * 1e6:.0f} us, '
+          f'parse_deadline {total_new / CORPUS.__len__() * 1e6:.0f} us per input')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
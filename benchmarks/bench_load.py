@@ -0,0 +1,268 @@
+"""Load benchmark of the command and notification paths against in-process fakes (see benchmarks.fakes).
+
+Builds fake guilds with --members members and --roles roles each, --tasks tasks with their assignees, and
+drives the wizard and cog code paths that matter at that size:
+    sweep                 Notifications.seed_scheduler, the reconcile pass of user_auto_notifications
+    dispatch              Notifications.dispatch_due, one op is --chunk due deadline notifications
+    set_task_description  Task.set_task_description with users and a role
+    assign_to             Assign.assign_to with users and a role
+    reaction_add          Notifications.on_raw_reaction_add toggling tasks complete
+Each scenario reports throughput, p50/p99 latency, and the allocations of a separate tracemalloc pass.
+--round-trip adds a fixed delay to every database request, by default only the bot's own cost is measured.
+
+Run from the repository root:
+    python -m benchmarks.bench_load --save benchmarks/results/baseline.json
+    python -m benchmarks.bench_load --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import discord
+import pytz
+from bson import ObjectId
+
+from benchmarks.fakes import FakeBot, FakeContext, FakeDatabase, FakeGuild
+from commands.assign import Assign
+from commands.task import Task
+from essentials.ledger import NotificationLedger
+from essentials.member_index import MemberIndex
+from essentials.messagecache import MessageCache
+from essentials.multi_server import TaskNameIndex
+from essentials.notifications import Notifications
+from essentials.sharding import ShardOwnership
+from essentials.taskcache import TaskCache
+from essentials.writebuffer import TaskWriteBuffer
+
+SCENARIOS = ['sweep', 'dispatch', 'set_task_description', 'assign_to', 'reaction_add']
+# metric -> whether higher is better
+METRICS = {'throughput': True, 'p50_ms': False, 'p99_ms': False, 'alloc_peak_kib': False,
+           'alloc_retained_kib_per_op': False}
+
+
+async def build(args):
+    """Bot wired with the real caches and cogs on top of fake guilds and collections"""
+    utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    db = FakeDatabase(args.round_trip)
+    per_guild = args.members // args.guilds
+    guilds = [FakeGuild((i + 1) << 32, per_guild, args.roles) for i in range(args.guilds)]
+    bot = FakeBot(guilds, db)
+    bot.message_cache = MessageCache(bot)
+    bot.task_cache = TaskCache()
+    bot.write_buffer = TaskWriteBuffer(bot)
+    bot.shard_ownership = ShardOwnership()
+    bot.task_names = TaskNameIndex()
+    bot.ledger = NotificationLedger(db.notification_ledger)
+    MemberIndex(bot)
+    for guild in guilds:
+        # built on startup in production, not part of any scenario
+        bot.member_index.guild(guild)
+
+    # the first --due tasks have their 7 day notification due, one second apart, starting a day ago
+    first_due = utc_now - datetime.timedelta(days=1)
+    tasks, users = [], {}
+    for i in range(args.tasks):
+        guild = guilds[i % args.guilds]
+        if i < args.due:
+            deadline = first_due + datetime.timedelta(days=7, seconds=i)
+        else:
+            deadline = utc_now + datetime.timedelta(days=8 + i % 60)
+        tasks.append({
+            '_id': ObjectId(), 'server_id': str(guild.id), 'task_name': f'task{i}',
+            'task_author': str(guild.members[i % per_guild].id), 'task_description': 'Write the quarterly report',
+            'task_role': [guild.roles[i % args.roles].id] if args.roles and i % 20 == 0 else [],
+            'date_created': utc_now - datetime.timedelta(days=2), 'deadline': deadline, 'deadline_tz': 1.0,
+            'deadline_tz_name': 'Europe/Dublin', 'task_complete': False, 'days_7_notified': False,
+            'day_1_notified': False, 'date_notified': None,
+        })
+        for k in range(args.assignees):
+            member = guild.members[(i * args.assignees + k) % per_guild]
+            user = users.setdefault((member.id, guild.id), {
+                '_id': ObjectId(), 'user_id': str(member.id), 'server_id': str(guild.id), 'tasks_assigned': []})
+            user['tasks_assigned'].append(f'task{i}')
+    db.tasks.insert_many_sync(tasks)
+    db.users.insert_many_sync(users.values())
+    return bot, SimpleNamespace(first_due=first_due, per_guild=per_guild)
+
+
+async def scenarios(bot, data, args):
+    """name -> (op(i) returning the number of items it handled, timed ops, tracemalloc ops)"""
+    guilds = bot.guilds
+    notifications = Notifications(bot)
+
+    def member(guild, i):
+        return guild.members[i % data.per_guild]
+
+    async def sweep(i):
+        await notifications.seed_scheduler()
+        return bot.deadline_scheduler.__len__()
+
+    async def dispatch(i):
+        # chunk i are the tasks due in the i-th window of --chunk seconds
+        utc_now = data.first_due + datetime.timedelta(seconds=(i + 1) * args.chunk - 0.5)
+        return await notifications.dispatch_due(utc_now)
+
+    async def set_task_description(i):
+        guild = guilds[i % guilds.__len__()]
+        ctx = FakeContext(guild, member(guild, i))
+        mentions = [f'<@!{member(guild, i + k).id}>' for k in range(1, 4)]
+        if args.roles:
+            mentions.append(f'<@&{guild.roles[i % args.roles].id}>')
+        bot.replies.append((ctx.author, 'Write the quarterly report'))
+        await Task(bot, ctx).set_task_description(ctx, mentions)
+        return 1
+
+    async def assign_to(i):
+        task = args.due + i % (args.tasks - args.due)
+        guild = guilds[task % guilds.__len__()]
+        ctx = FakeContext(guild, member(guild, task))
+        mentions = [f'<@!{member(guild, i * 3 + k + 1).id}>' for k in range(3)]
+        if args.roles:
+            mentions.append(f'<@&{guild.roles[(i + 1) % args.roles].id}>')
+        bot.replies.append((ctx.author, ' '.join(mentions)))
+        await Assign(bot, ctx).assign_to(ctx, f'task{task}')
+        return 1
+
+    # messages showing the embeds of the tasks after the due ones, every round of reactions toggles them
+    posted = []
+    for task in range(args.due, min(args.tasks, args.due + args.messages)):
+        guild = guilds[task % guilds.__len__()]
+        message = await guild.text_channel.send(embed=discord.Embed().set_author(name=f' >> task{task} '))
+        posted.append((guild, message, task))
+
+    async def reaction_add(i):
+        guild, message, task = posted[i % posted.__len__()]
+        emoji = '✅' if (i // posted.__len__()) % 2 == 0 else '❌'
+        await notifications.on_raw_reaction_add(SimpleNamespace(
+            user_id=member(guild, task).id, emoji=discord.PartialEmoji(name=emoji),
+            message_id=message.id, channel_id=message.channel.id))
+        return 1
+
+    return {
+        'sweep': (sweep, args.sweeps, 1),
+        'dispatch': (dispatch, max(args.due // args.chunk - 1, 1), 1),
+        'set_task_description': (set_task_description, args.ops, args.alloc_ops),
+        'assign_to': (assign_to, args.ops, args.alloc_ops),
+        'reaction_add': (reaction_add, args.ops, args.alloc_ops),
+    }
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(sorted_values.__len__() - 1, int(q * sorted_values.__len__()))]
+
+
+async def run(bot, op, ops, alloc_ops):
+    """tracemalloc pass over the first alloc_ops indices (which also warms up), then the timed pass"""
+    db_ops = bot.db.ops()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(alloc_ops):
+        await op(i)
+    await bot.write_buffer.flush()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db_ops = bot.db.ops() - db_ops
+
+    latencies = []
+    items = 0
+    started = time.perf_counter()
+    for i in range(alloc_ops, alloc_ops + ops):
+        op_started = time.perf_counter()
+        items += await op(i)
+        latencies.append(time.perf_counter() - op_started)
+    # writes buffered during the pass are part of its cost
+    await bot.write_buffer.flush()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'ops': ops,
+        'items': items,
+        'throughput': items / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'alloc_peak_kib': (peak - before) / 1024,
+        'alloc_retained_kib_per_op': (current - before) / 1024 / alloc_ops,
+        'db_ops_per_op': db_ops / alloc_ops,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline, returns the regressions beyond tolerance"""
+    if baseline['params'] != results['params']:
+        print(f'warning: baseline was run with {baseline["params"]}')
+    regressions = []
+    print(f'{"scenario":<22}{"metric":<28}{"baseline":>12}{"current":>12}{"change":>9}')
+    for name, metrics in results['scenarios'].items():
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if not old.get(metric):
+                continue
+            change = metrics[metric] / old[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ' !' if worse > tolerance else ''
+            if flag:
+                regressions.append((name, metric))
+            print(f'{name:<22}{metric:<28}{old[metric]:>12.2f}{metrics[metric]:>12.2f}{change * 100:>8.1f}%{flag}')
+    return regressions
+
+
+async def main(args):
+    bot, data = await build(args)
+    available = await scenarios(bot, data, args)
+    results = {'params': {k: v for k, v in vars(args).items() if k not in ('save', 'compare', 'tolerance', 'only')},
+               'python': platform.python_version(), 'scenarios': {}}
+    for name in args.only or SCENARIOS:
+        # the code under test prints a lot
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results['scenarios'][name] = await run(bot, *available[name])
+        r = results['scenarios'][name]
+        print(f'{name:<22}{r["throughput"]:>10.1f}/s  p50 {r["p50_ms"]:8.2f} ms  p99 {r["p99_ms"]:8.2f} ms  '
+              f'peak {r["alloc_peak_kib"]:9.1f} KiB  retained {r["alloc_retained_kib_per_op"]:8.2f} KiB/op  '
+              f'db {r["db_ops_per_op"]:6.1f}/op')
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load benchmark of the bot against in-process fakes.')
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=100000, help='members over all guilds')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--roles', type=int, default=50, help='roles per guild, members have two each')
+    parser.add_argument('--assignees', type=int, default=5, help='users assigned to each task')
+    parser.add_argument('--due', type=int, default=2000, help='tasks with a notification due')
+    parser.add_argument('--chunk', type=int, default=100, help='due tasks per dispatch')
+    parser.add_argument('--messages', type=int, default=1000, help='task messages that get reactions')
+    parser.add_argument('--ops', type=int, default=1000, help='timed ops of the interactive scenarios')
+    parser.add_argument('--alloc-ops', type=int, default=100, help='ops of the tracemalloc pass')
+    parser.add_argument('--sweeps', type=int, default=5)
+    parser.add_argument('--round-trip', type=float, default=0.0, help='seconds added to every database request')
+    parser.add_argument('--only', nargs='+', choices=SCENARIOS)
+    parser.add_argument('--save', help='write the results as json, e.g. a new baseline')
+    parser.add_argument('--compare', help='baseline json to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.get_event_loop().run_until_complete(main(args))
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f'{regressions.__len__()} regressions beyond {args.tolerance * 100:.0f}%')
+            sys.exit(1)
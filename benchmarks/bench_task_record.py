@@ -0,0 +1,57 @@
+"""Memory needed to hold 100k loaded tasks as Task objects and as TaskRecords.
+
+Run from the repository root: python -m benchmarks.bench_task_record
+"""
+import asyncio
+import datetime
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from commands.task import Task
+from essentials.records import TaskRecord
+
+N = 100000
+
+
+def documents(n):
+    created = datetime.datetime(2030, 1, 1)
+    for i in range(n):
+        yield {
+            '_id': '5f0c6f0e8b3b3a0001%06d' % i, 'server_id': str(1000 + i % 50), 'task_name': f'task{i}',
+            'task_author': str(2000 + i % 500), 'task_description': 'Write the report for the next meeting',
+            'task_role': [], 'date_created': created, 'deadline': created + datetime.timedelta(days=i % 30),
+            'deadline_tz': 1.0, 'deadline_tz_name': 'Europe/Dublin', 'task_complete': False,
+            'days_7_notified': False, 'day_1_notified': False, 'date_notified': None,
+        }
+
+
+async def load_tasks(bot, docs):
+    tasks = []
+    for d in docs:
+        t = Task(bot, load=True)
+        await t.task_from_dict(d)
+        tasks.append(t)
+    return tasks
+
+
+def measure(label, load):
+    docs = list(documents(N))
+    tracemalloc.start()
+    start = time.perf_counter()
+    loaded = load(docs)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<12}{current / N:8.0f} bytes/task {current / 2 ** 20:8.1f} MiB {elapsed:6.2f} s')
+    return loaded
+
+
+def main():
+    bot = SimpleNamespace(get_guild=lambda server_id: None)
+    measure('Task', lambda docs: asyncio.get_event_loop().run_until_complete(load_tasks(bot, docs)))
+    measure('TaskRecord', lambda docs: [TaskRecord.from_doc(d) for d in docs])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Cost of resolving the deadline timezone of one task render, before and after the offset index.
+
+Run from the repository root: python -m benchmarks.bench_timezones
+"""
+import datetime as dt
+import timeit
+
+import pytz
+
+from utils.misc import possible_timezones, resolve_timezone
+
+
+def scan_timezones(tz_offset):
+    # the original implementation: walk every common timezone on each call
+    offset_days, offset_seconds = 0, int(tz_offset * 3600)
+    if offset_seconds < 0:
+        offset_days = -1
+        offset_seconds += 24 * 3600
+    desired_delta = dt.timedelta(offset_days, offset_seconds)
+    null_delta = dt.timedelta(0, 0)
+    results = []
+    for tz_name in pytz.common_timezones:
+        tz = pytz.timezone(tz_name)
+        non_dst_offset = getattr(tz, '_transition_info', [[null_delta]])[-1]
+        if desired_delta == non_dst_offset[0]:
+            results.append(tz_name)
+    return results
+
+
+def main(number=200):
+    deadline = pytz.utc.localize(dt.datetime(2030, 1, 1, 12))
+    offsets = [1.0, -5.0, 5.5, 0.0]
+
+    def before():
+        for offset in offsets:
+            deadline.astimezone(pytz.timezone(scan_timezones(offset)[0]))
+
+    def after_offset():
+        for offset in offsets:
+            deadline.astimezone(resolve_timezone(None, offset))
+
+    def after_name():
+        deadline.astimezone(resolve_timezone('Europe/Dublin', 1.0))
+
+    assert [scan_timezones(o) for o in offsets] == [possible_timezones(o) for o in offsets]
+    for label, fn, per in (('linear scan', before, len(offsets)),
+                           ('offset index + lru', after_offset, len(offsets)),
+                           ('stored zone name', after_name, 1)):
+        t = timeit.timeit(fn, number=number)
+        print(f'{label:>20}: {t / (number * per) * 1e6:10.2f} us per render')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Two processes splitting the shards between them, in one process on top of the fakes (see benchmarks.fakes).
+
+Checks that the ShardOwnership of each process owns exactly its guilds and that together they own every
+guild once, and that a ✅ reaction on a task DM is applied whichever process the task belongs to: DM events
+only arrive on shard 0, reactions for servers of the other process are forwarded through the database.
+Also runs the startup catch up of a process: the first one only backfills the ledger, later ones post the
+task to assignees the ledger doesn't know.
+Exits with an assertion error if anything is off.
+
+Run from the repository root: python -m benchmarks.check_sharding
+"""
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import discord
+import pytz
+from bson import ObjectId
+
+from benchmarks.fakes import FakeBot, FakeDatabase, FakeGuild
+from essentials.ledger import NotificationLedger
+from essentials.member_index import MemberIndex
+from essentials.messagecache import MessageCache
+from essentials.multi_server import TaskNameIndex
+from essentials.notifications import Notifications
+from essentials.sharding import ShardOwnership
+from essentials.taskcache import TaskCache
+from essentials.writebuffer import TaskWriteBuffer
+
+SHARD_COUNT = 2
+GUILDS = 8
+
+
+def process(shard_id, guilds, db):
+    """Bot of the process running shard_id, it only sees the guilds on that shard"""
+    ownership = ShardOwnership([shard_id], SHARD_COUNT)
+    bot = FakeBot([g for g in guilds if ownership.owns(g.id)], db, api_guilds=guilds)
+    bot.shard_ownership = ownership
+    bot.message_cache = MessageCache(bot)
+    bot.task_cache = TaskCache()
+    bot.write_buffer = TaskWriteBuffer(bot)
+    bot.task_names = TaskNameIndex()
+    bot.ledger = NotificationLedger(db.notification_ledger)
+    MemberIndex(bot)
+    notifications = Notifications(bot)
+    # the check drives handle_forwarded_reactions itself
+    notifications.cog_unload()
+    return bot, notifications
+
+
+def reaction(member, message):
+    return SimpleNamespace(user_id=member.id, emoji=discord.PartialEmoji(name='✅'), message_id=message.id,
+                           channel_id=member.dm_channel.id)
+
+
+async def complete(db, guild, task_name):
+    task = await db.tasks.find_one({'server_id': str(guild.id), 'task_name': task_name})
+    return task['task_complete']
+
+
+async def main():
+    utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    db = FakeDatabase()
+    # consecutive ids on the shard formula's bits, the guilds alternate between the shards
+    guilds = [FakeGuild((i + 1) << 22, 10, 2) for i in range(GUILDS)]
+    (bot0, notifications0), (bot1, notifications1) = process(0, guilds, db), process(1, guilds, db)
+
+    owned0 = set(bot0.shard_ownership.owned_server_ids(guilds))
+    owned1 = set(bot1.shard_ownership.owned_server_ids(guilds))
+    assert owned0 and owned1 and not owned0 & owned1, (owned0, owned1)
+    assert owned0 | owned1 == {str(g.id) for g in guilds}
+    assert owned0 == {str(g.id) for g in bot0.guilds} and owned1 == {str(g.id) for g in bot1.guilds}
+    assert bot1.shard_ownership.query(bot1.guilds) == {'server_id': {'$in': sorted(owned1, key=int)}}
+
+    for guild in guilds:
+        member = guild.members[0]
+        db.tasks.insert_many_sync([{
+            '_id': ObjectId(), 'server_id': str(guild.id), 'task_name': f'task{guild.id}',
+            'task_author': str(member.id), 'task_description': 'Write the quarterly report', 'task_role': [],
+            'date_created': utc_now, 'deadline': utc_now + datetime.timedelta(days=30), 'deadline_tz': 0.0,
+            'deadline_tz_name': 'UTC', 'task_complete': False, 'days_7_notified': False,
+            'day_1_notified': False, 'date_notified': None,
+        }])
+        db.users.insert_many_sync([{'_id': ObjectId(), 'user_id': str(member.id), 'server_id': str(guild.id),
+                                    'tasks_assigned': [f'task{guild.id}']}])
+
+    local, remote = bot0.guilds[0], bot1.guilds[0]
+    for guild in (local, remote):
+        member = guild.members[0]
+        message = await member.send(embed=discord.Embed().set_author(name=f' >> task{guild.id} '))
+        # DM events only reach the process running shard 0
+        await notifications0.on_raw_reaction_add(reaction(member, message))
+    await bot0.write_buffer.flush()
+
+    assert await complete(db, local, f'task{local.id}'), 'the DM reaction for a guild of shard 0 was not applied'
+    assert not await complete(db, remote, f'task{remote.id}'), 'shard 0 changed a task of shard 1'
+    assert db.forwarded_reactions.__len__() == 1, 'the DM reaction for a guild of shard 1 was not forwarded'
+    assert await notifications0.handle_forwarded_reactions() == 0, 'shard 0 took a reaction of shard 1'
+
+    assert await notifications1.handle_forwarded_reactions() == 1
+    await bot1.write_buffer.flush()
+    assert await complete(db, remote, f'task{remote.id}'), 'the forwarded reaction was not applied by shard 1'
+    assert db.forwarded_reactions.__len__() == 0
+
+    # the first start backfills the ledger, the assignees already got their tasks
+    guild = bot1.guilds[1]
+    assignee, added = guild.members[0], guild.members[1]
+    received = assignee.received
+    await notifications1.startup_notifications()
+    assert assignee.received == received, 'the first catch up posted tasks the assignees already have'
+    await db.users.update_one({'user_id': str(added.id), 'server_id': str(guild.id)},
+                              {'$addToSet': {'tasks_assigned': f'task{guild.id}'}}, upsert=True)
+    await notifications1.startup_notifications()
+    assert added.received == 1, 'the catch up did not post the task to an assignee missing from the ledger'
+    assert assignee.received == received
+    await notifications1.startup_notifications()
+    assert added.received == 1, 'the catch up posted the task twice'
+    print(f'{GUILDS} guilds on {SHARD_COUNT} shards: ownership partitions the guilds, '
+          f'DM reactions are applied on both shards, the startup catch up posts only what is missing')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,528 @@
+"""In-process stand-ins for MongoDB (motor) and the discord objects the bot touches.
+
+FakeCollection keeps the documents in a dict and understands the subset of the query and update language
+this repository uses. Like mongo it answers equality and $in queries on the configured indexes without a
+scan, everything else is a collection scan. Every request can be delayed by a fixed round trip.
+The discord fakes only implement what the commands and cogs call.
+"""
+import asyncio
+import datetime
+import itertools
+from collections import Counter, deque
+from types import SimpleNamespace
+
+import discord
+from bson import ObjectId
+
+_MISSING = object()
+
+
+def _equals(value, cond):
+    # a query value matches an array field if one of the elements matches
+    if isinstance(value, list) and not isinstance(cond, list):
+        return cond in value
+    return value == cond
+
+
+def _compare(op):
+    def compare(value, arg):
+        if value is _MISSING or value is None:
+            return False
+        try:
+            return op(value, arg)
+        except TypeError:
+            return False
+    return compare
+
+
+_OPERATORS = {
+    '$in': lambda value, arg: any(_equals(value, x) for x in arg),
+    '$nin': lambda value, arg: not any(_equals(value, x) for x in arg),
+    '$ne': lambda value, arg: not _equals(value, arg),
+    '$exists': lambda value, arg: (value is not _MISSING) == bool(arg),
+    '$lt': _compare(lambda a, b: a < b),
+    '$lte': _compare(lambda a, b: a <= b),
+    '$gt': _compare(lambda a, b: a > b),
+    '$gte': _compare(lambda a, b: a >= b),
+}
+
+
+def _add(args):
+    if isinstance(args[0], datetime.datetime):
+        # dates plus milliseconds
+        return args[0] + datetime.timedelta(milliseconds=sum(args[1:]))
+    return sum(args)
+
+
+_EXPRESSIONS = {
+    '$and': all,
+    '$or': any,
+    '$add': _add,
+    '$lt': lambda args: args[0] < args[1],
+    '$lte': lambda args: args[0] <= args[1],
+    '$gt': lambda args: args[0] > args[1],
+    '$gte': lambda args: args[0] >= args[1],
+    '$eq': lambda args: args[0] == args[1],
+}
+
+
+def _evaluate(doc, expression):
+    if isinstance(expression, str) and expression.startswith('$'):
+        return doc.get(expression[1:])
+    if isinstance(expression, dict) and expression.__len__() == 1:
+        op, args = next(iter(expression.items()))
+        if op in _EXPRESSIONS:
+            return _EXPRESSIONS[op]([_evaluate(doc, arg) for arg in args])
+    return expression
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        if key == '$or':
+            if not any(matches(doc, branch) for branch in cond):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, branch) for branch in cond):
+                return False
+        elif key == '$expr':
+            try:
+                if not _evaluate(doc, cond):
+                    return False
+            except TypeError:
+                # e.g. a missing date, mongo orders null before everything
+                return False
+        elif isinstance(cond, dict) and cond and all(op.startswith('$') for op in cond):
+            value = doc.get(key, _MISSING)
+            if not all(_OPERATORS[op](value, arg) for op, arg in cond.items()):
+                return False
+        elif not _equals(doc.get(key, _MISSING), cond):
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if projection:
+        include_id = projection.get('_id', 1)
+        doc = {k: v for k, v in doc.items() if projection.get(k) or (k == '_id' and include_id)}
+    # callers must not be able to change the stored document
+    return {k: list(v) if isinstance(v, list) else v for k, v in doc.items()}
+
+
+class FakeCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+        self._batch_size = 101
+
+    def sort(self, keys, direction=None):
+        self._sort = [(keys, direction or 1)] if isinstance(keys, str) else keys
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def batch_size(self, n):
+        self._batch_size = n
+        return self
+
+    def _results(self):
+        docs = self._collection._find(self._query)
+        if self._sort:
+            for field, direction in reversed(self._sort):
+                docs.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        if self._limit:
+            docs = docs[:self._limit]
+        return [_project(d, self._projection) for d in docs]
+
+    async def __aiter__(self):
+        await self._collection._round_trip('find')
+        for i, doc in enumerate(self._results(), 1):
+            yield doc
+            if i % self._batch_size == 0:
+                # getMore
+                await self._collection._round_trip('getmore')
+
+    async def to_list(self, length=None):
+        await self._collection._round_trip('find')
+        docs = self._results()
+        return docs[:length] if length else docs
+
+
+class FakeCollection:
+    """Dict backed collection. indexes are tuples of field names, array fields are indexed per element"""
+
+    def __init__(self, indexes=(), round_trip=0.0):
+        self.round_trip = round_trip
+        self.ops = Counter()
+        self._docs = {}  # _id -> doc
+        self._indexes = {fields: {} for fields in indexes}  # fields -> {values: {_id, ...}}
+
+    async def _round_trip(self, op):
+        self.ops[op] += 1
+        await asyncio.sleep(self.round_trip)
+
+    @staticmethod
+    def _index_keys(doc, fields):
+        values = []
+        for field in fields:
+            value = doc.get(field)
+            values.append(value if isinstance(value, list) else [value])
+        return itertools.product(*values)
+
+    def _index(self, doc):
+        for fields, index in self._indexes.items():
+            for key in self._index_keys(doc, fields):
+                index.setdefault(key, set()).add(doc['_id'])
+
+    def _unindex(self, doc):
+        for fields, index in self._indexes.items():
+            for key in self._index_keys(doc, fields):
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(doc['_id'])
+
+    def _candidates(self, query):
+        """Ids that can match the query according to an index, None if the collection has to be scanned"""
+        if '_id' in query:
+            cond = query['_id']
+            if not isinstance(cond, dict):
+                return {cond}
+            if set(cond) == {'$in'}:
+                return set(cond['$in'])
+        for fields, index in self._indexes.items():
+            values = []
+            for field in fields:
+                cond = query.get(field, _MISSING)
+                if isinstance(cond, dict) and set(cond) == {'$in'}:
+                    values.append(cond['$in'])
+                elif cond is _MISSING or isinstance(cond, (dict, list)):
+                    break
+                else:
+                    values.append([cond])
+            else:
+                ids = set()
+                for key in itertools.product(*values):
+                    ids |= index.get(key, set())
+                return ids
+        if '$or' in query:
+            ids = set()
+            for branch in query['$or']:
+                branch_ids = self._candidates(branch)
+                if branch_ids is None:
+                    return None
+                ids |= branch_ids
+            return ids
+        return None
+
+    def _find(self, query):
+        ids = self._candidates(query)
+        docs = self._docs.values() if ids is None else (self._docs[i] for i in ids if i in self._docs)
+        return [d for d in docs if matches(d, query)]
+
+    @staticmethod
+    def _apply(doc, update, inserted):
+        for op, fields in update.items():
+            for field, value in fields.items():
+                if op == '$set' or (op == '$setOnInsert' and inserted):
+                    doc[field] = value
+                elif op == '$unset':
+                    doc.pop(field, None)
+                elif op == '$inc':
+                    doc[field] = doc.get(field, 0) + value
+                elif op == '$addToSet':
+                    values = doc.setdefault(field, [])
+                    for v in value['$each'] if isinstance(value, dict) else [value]:
+                        if v not in values:
+                            values.append(v)
+                elif op != '$setOnInsert':
+                    raise NotImplementedError(op)
+
+    def _insert(self, doc):
+        doc.setdefault('_id', ObjectId())
+        self._docs[doc['_id']] = doc
+        self._index(doc)
+        return doc['_id']
+
+    def _update(self, query, update, upsert, many=False):
+        docs = self._find(query)
+        if not many:
+            docs = docs[:1]
+        for doc in docs:
+            self._unindex(doc)
+            self._apply(doc, update, False)
+            self._index(doc)
+        upserted_id = None
+        if not docs and upsert:
+            doc = {k: v for k, v in query.items() if not k.startswith('$') and not isinstance(v, dict)}
+            self._apply(doc, update, True)
+            upserted_id = self._insert(doc)
+        return SimpleNamespace(matched_count=docs.__len__(), modified_count=docs.__len__(), upserted_id=upserted_id)
+
+    def insert_many_sync(self, docs):
+        """Load documents without a round trip, for building the data set"""
+        for doc in docs:
+            self._insert(doc)
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query or {}, projection)
+
+    async def find_one(self, query=None, projection=None):
+        await self._round_trip('find_one')
+        docs = self._find(query or {})
+        return _project(docs[0], projection) if docs else None
+
+    async def count_documents(self, query):
+        await self._round_trip('count')
+        return self._find(query).__len__()
+
+    async def insert_one(self, doc):
+        await self._round_trip('insert_one')
+        return SimpleNamespace(inserted_id=self._insert(dict(doc)))
+
+    async def update_one(self, query, update, upsert=False):
+        await self._round_trip('update_one')
+        return self._update(query, update, upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        await self._round_trip('update_many')
+        return self._update(query, update, upsert, many=True)
+
+    async def delete_many(self, query):
+        await self._round_trip('delete_many')
+        docs = self._find(query)
+        for doc in docs:
+            self._unindex(doc)
+            del self._docs[doc['_id']]
+        return SimpleNamespace(deleted_count=docs.__len__())
+
+    async def find_one_and_delete(self, query, projection=None, sort=None):
+        await self._round_trip('find_one_and_delete')
+        docs = self._find(query)
+        for field, direction in reversed(sort or []):
+            docs.sort(key=lambda d: d.get(field), reverse=direction < 0)
+        if not docs:
+            return None
+        self._unindex(docs[0])
+        return _project(self._docs.pop(docs[0]['_id']), projection)
+
+    async def bulk_write(self, requests, ordered=True):
+        # only UpdateOne is used with bulk_write
+        await self._round_trip('bulk_write')
+        results = [self._update(r._filter, r._doc, r._upsert) for r in requests]
+        return SimpleNamespace(matched_count=sum(r.matched_count for r in results),
+                               upserted_count=sum(1 for r in results if r.upserted_id is not None))
+
+    async def create_index(self, keys, **kwargs):
+        return ''
+
+    def __len__(self):
+        return self._docs.__len__()
+
+
+class FakeDatabase:
+    """The collections of the bot with the indexes of essentials.indexes"""
+
+    def __init__(self, round_trip=0.0):
+        self.tasks = FakeCollection([('server_id', 'task_name')], round_trip)
+        self.users = FakeCollection([('user_id', 'server_id'), ('server_id', 'tasks_assigned')], round_trip)
+        self.config = FakeCollection(round_trip=round_trip)
+        self.notification_ledger = FakeCollection(round_trip=round_trip)
+        self.bot_messages = FakeCollection(round_trip=round_trip)
+        self.leases = FakeCollection(round_trip=round_trip)
+        self.forwarded_reactions = FakeCollection([('server_id',)], round_trip)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def collections(self):
+        return [c for c in vars(self).values() if isinstance(c, FakeCollection)]
+
+    def ops(self):
+        return sum(sum(c.ops.values()) for c in self.collections())
+
+
+_snowflakes = itertools.count(700000000000000000)
+
+
+def snowflake():
+    return next(_snowflakes)
+
+
+class FakeRole:
+    def __init__(self, guild, id, name):
+        self.guild = guild
+        self.id = id
+        self.name = name
+
+
+class FakeDMChannel(discord.DMChannel):
+    """Passes the isinstance checks of the bot, nothing of discord.DMChannel.__init__ runs"""
+
+    def __init__(self, recipient):
+        self.id = recipient.id
+        self.recipient = recipient
+        self.messages = {}
+
+    async def fetch_message(self, id):
+        if id not in self.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self.messages[id]
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content='', embed=None):
+        self.id = snowflake()
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = [self._received(embed)] if embed is not None else []
+        self.reactions = Counter()
+
+    @staticmethod
+    def _received(embed):
+        # discord trims the author name, the client parses the embed from the response
+        data = embed.to_dict()
+        if 'author' in data:
+            data['author']['name'] = data['author']['name'].strip()
+        return discord.Embed.from_dict(data)
+
+    async def edit(self, content=None, embed=None):
+        if embed is not None:
+            self.embeds = [self._received(embed)]
+        return self
+
+    async def add_reaction(self, emoji):
+        self.reactions[str(emoji)] += 1
+
+    async def remove_reaction(self, emoji, member):
+        self.reactions[str(emoji)] -= 1
+
+
+class FakeMember:
+    def __init__(self, guild, id, roles=(), bot=False):
+        self.guild = guild
+        self.id = id
+        self.name = self.display_name = f'member{id}'
+        self.roles = list(roles)
+        self.bot = bot
+        self.dm_channel = FakeDMChannel(self)
+        self.received = 0
+
+    async def send(self, content=None, embed=None):
+        self.received += 1
+        message = FakeMessage(self.dm_channel, None, content, embed)
+        self.dm_channel.messages[message.id] = message
+        return message
+
+    async def create_dm(self):
+        return self.dm_channel
+
+
+class FakeTextChannel(discord.TextChannel):
+    """Passes the isinstance checks of the bot, nothing of discord.TextChannel.__init__ runs"""
+
+    def __init__(self, guild, id):
+        self.guild = guild
+        self.id = id
+        self.name = f'channel{id}'
+        self.messages = {}
+
+    async def send(self, content=None, embed=None):
+        message = FakeMessage(self, None, content, embed)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, id):
+        if id not in self.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self.messages[id]
+
+
+class FakeGuild:
+    def __init__(self, id, member_count, role_count, roles_per_member=2):
+        self.id = id
+        self.name = f'guild{id}'
+        self.roles = [FakeRole(self, id + 1 + i, f'role{i}') for i in range(role_count)]
+        self.members = []
+        self._members = {}
+        for i in range(member_count):
+            roles = [self.roles[(i * 7 + j * 13) % role_count] for j in range(roles_per_member)] if role_count else []
+            self._add(FakeMember(self, id + role_count + 1 + i, roles))
+        self.text_channel = FakeTextChannel(self, id + role_count + member_count + 1)
+
+    def _add(self, member):
+        self.members.append(member)
+        self._members[member.id] = member
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    def get_role(self, role_id):
+        return next((r for r in self.roles if r.id == role_id), None)
+
+
+class FakeContext:
+    """Command context of a message sent by author in the guild's text channel"""
+
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.channel = guild.text_channel
+        self.message = SimpleNamespace(guild=guild, author=author, channel=guild.text_channel)
+
+    async def send(self, content=None, embed=None):
+        return await self.channel.send(content, embed=embed)
+
+
+class FakeBot:
+    """Attributes and methods of the discord client the cogs and commands use.
+    Replies to the wizards are queued in `replies` and handed out by wait_for.
+    `guilds` are the guilds of this process' shards, the fetch_* methods ask the API, which knows all of
+    `api_guilds` (by default the same)"""
+
+    def __init__(self, guilds, db, api_guilds=None):
+        self.user = SimpleNamespace(id=0, bot=True)
+        self.guilds = guilds
+        self.db = db
+        self.loop = asyncio.get_event_loop()
+        self.replies = deque()
+        self.cogs = {}
+        self._guilds = {g.id: g for g in guilds}
+        self._channels = {g.text_channel.id: g.text_channel for g in guilds}
+        self._api_guilds = {g.id: g for g in (api_guilds or guilds)}
+        self._api_users = {m.id: m for g in self._api_guilds.values() for m in g.members}
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def get_user(self, user_id):
+        return next((g.get_member(user_id) for g in self.guilds if g.get_member(user_id)), None)
+
+    async def fetch_guild(self, guild_id):
+        return self._api_guilds[guild_id]
+
+    async def fetch_user(self, user_id):
+        user = self._api_users[user_id]
+        # create_dm puts the channel into the cache
+        self._channels[user.dm_channel.id] = user.dm_channel
+        return user
+
+    async def fetch_channel(self, channel_id):
+        for guild in self._api_guilds.values():
+            if guild.text_channel.id == channel_id:
+                return guild.text_channel
+        return self._api_users[channel_id].dm_channel
+
+    def is_closed(self):
+        return False
+
+    async def wait_for(self, event, check=None, timeout=None):
+        author, content = self.replies.popleft()
+        return FakeMessage(None, author, content)
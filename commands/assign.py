@@ -1,4 +1,8 @@
 from commands.task import Task
+from essentials.fanout import deliver
+from essentials.ledger import ASSIGNED
+from essentials.outbound import outbound
+from essentials.taskcache import find_task
 
 
 class Assign:
@@ -9,19 +13,22 @@ class Assign:
 
     async def assign_to(self, ctx, task_name):
         self.task_name = task_name
-        query = await self.bot.db.tasks.find_one({'task_name': task_name, 'server_id': str(self.server.id)})
+        query = await find_task(self.bot, self.server.id, task_name)
         t = Task(self.bot, ctx)
         userquery = self.bot.db.users.find({'tasks_assigned': task_name, 'server_id': str(self.server.id)})
         if query:
             await t.task_from_dict(query)
             if userquery:
                 for limiter, utd in enumerate([tasks async for tasks in userquery]):
-                    await t.users_from_dict(utd)
+                    t.users_from_dict(utd)
             await t.assign_task()
             await t.save_task_to_db()
-            await t.save_user_task_to_db()
+            await t.save_assignees(ctx.channel)
             await t.clean_up(ctx.channel)
+            # the earlier assignees are in the ledger already, only the new ones get the task
+            await deliver(self.bot, t, ASSIGNED)
         else:
-            await ctx.send(f'**I can\'t find the task **{task_name}**.**')
+            await outbound(self.bot, 'send', ctx.channel.id,
+                           lambda: ctx.send(f'**I can\'t find the task **{task_name}**.**'))
 
         #await t.save_task_to_db()
\ No newline at end of file
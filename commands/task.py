@@ -1,51 +1,75 @@
 import asyncio
+import copy
 import datetime
 import logging
-import os
 import sys
 import time
 import traceback
 from string import ascii_lowercase
 
-import dateparser
 import pytz
-import regex
 from functools import reduce
+from collections import OrderedDict
 from operator import contains, or_
 
 import discord
 from bson import ObjectId
-from discord.utils import get
-from matplotlib import rcParams
-from matplotlib.afm import AFM
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-from pytz import timezone, UnknownTimeZoneError
-from unidecode import unidecode
+from pytz import timezone
 
 from essentials.exceptions import *
+from essentials.outbound import outbound, INTERACTIVE
+from essentials.records import TaskRecord
 from essentials.settings import SETTINGS
+from essentials.taskcache import find_task
 
-# Helvetica is the closest font to Whitney (discord uses Whitney) in afm
+from utils.deadline_parser import parse_deadline
+from utils.misc import resolve_timezone
 # This is used to estimate text width and adjust the layout of the embeds
-from utils.misc import possible_timezones
-
-afm_fname = os.path.join(rcParams['datapath'], 'fonts', 'afm', 'phvr8a.afm')
-with open(afm_fname, 'rb') as fh:
-    afm = AFM(fh)
+from utils.textwidth import string_width
 
 AZ_EMOJIS = [(b'\\U0001f1a'.replace(b'a', bytes(hex(224 + (6 + i))[2:], "utf-8"))).decode("unicode-escape") for i in
              range(26)]
 
 
+# rendered embeds, (task id, version) -> embed dict
+_RENDERED = OrderedDict()
+_RENDERED_MAX = 2000
+
+
+def _embed_content(data):
+    """What a user sees of an embed dict, discord trims what it is sent and adds to it (e.g. image sizes)"""
+    return (data.get('title', ''), data.get('description', ''), data.get('color'),
+            data.get('author', {}).get('name', '').strip(),
+            [(f.get('name', '').strip(), f.get('value', '').strip(), f.get('inline', False))
+             for f in data.get('fields', [])],
+            data.get('footer', {}).get('text', '').strip())
+
+
+def _remember(cache, key, value, max_size):
+    cache[key] = value
+    cache.move_to_end(key)
+    if cache.__len__() > max_size:
+        cache.popitem(last=False)
+
+
 class Task:
+    # changing one of these changes the rendered embed
+    DISPLAYED_FIELDS = ('task_name', 'task_description', 'task_complete', 'deadline', 'deadline_tz',
+                        'deadline_tz_name')
 
     def __init__(self, client, ctx=None, load=False, server=None):
+        self._version = None
         self.bot = client
         self.cursor_pos = 0
         self.ctx = ctx
 
         self.user_ids = []
         self.user_list = []
+        # the fields as they were last loaded or saved, to write only what changed
+        self._saved = {}
 
         if not load and ctx:
             if server is None:
@@ -61,6 +85,7 @@ class Task:
             self.date_created = None
             self.deadline = None
             self.deadline_tz = 1
+            self.deadline_tz_name = None
             self.task_complete = False
             self.days_7_notified = False
             self.day_1_notified = False
@@ -83,7 +108,7 @@ class Task:
         embed = discord.Embed(title="task creation Wizard", description=text, color=SETTINGS.color)
         if footer:
             embed.set_footer(text="Type `stop` to cancel the wizard.")
-        msg = await ctx.send(embed=embed)
+        msg = await outbound(self.bot, 'send', ctx.channel.id, lambda: ctx.send(embed=embed))
         self.wizard_messages.append(msg)
         return msg
 
@@ -99,12 +124,14 @@ class Task:
         self.date_created = d['date_created']
         self.deadline = d['deadline']
         self.deadline_tz = d['deadline_tz']
+        self.deadline_tz_name = d.get('deadline_tz_name')
         self.days_7_notified = d['days_7_notified']
         self.day_1_notified = d['day_1_notified']
         self.date_notified = d['date_notified']
         self.task_role = d['task_role']
         self.cursor_pos = 0
         self.task_complete = d['task_complete']
+        self._saved = self._snapshot(d)
 
     def users_from_dict(self, d, role=False):
         self.user_list.append(self.server.get_member(int(d['user_id'])))
@@ -118,6 +145,7 @@ class Task:
             'task_role': self.task_role,
             'date_created': self.date_created,
             'deadline_tz': self.deadline_tz,
+            'deadline_tz_name': self.deadline_tz_name,
             'deadline': self.deadline,
             'task_complete': self.task_complete,
             'days_7_notified': self.days_7_notified,
@@ -125,10 +153,45 @@ class Task:
             'date_notified': self.date_notified
         })
 
+    @staticmethod
+    def _snapshot(d):
+        # copy the lists, they are changed in place (e.g. task_role)
+        return {k: list(v) if isinstance(v, list) else v for k, v in d.items() if k != '_id'}
+
     async def save_task_to_db(self):
         try:
-            await self.bot.db.tasks.update_one({'server_id': str(self.server.id), 'task_name': self.task_name},
-                                           {'$set': await self.task_to_dict()}, upsert=True)
+            d = await self.task_to_dict()
+            changed = {k: v for k, v in d.items() if k not in self._saved or self._saved[k] != v}
+            if not changed:
+                return
+            if self.id is None or not hasattr(self.bot, 'write_buffer'):
+                # new tasks are written right away so they get an _id and other workers can see them
+                result = await self.bot.db.tasks.update_one(
+                    {'server_id': str(self.server.id), 'task_name': self.task_name}, {'$set': d}, upsert=True)
+                if result.upserted_id is not None:
+                    self.id = result.upserted_id
+                current = dict(d, _id=self.id)
+                if hasattr(self.bot, 'task_cache'):
+                    if self.id is not None:
+                        self.bot.task_cache.put(current)
+                    else:
+                        self.bot.task_cache.invalidate(d['server_id'], d['task_name'])
+            else:
+                self.bot.write_buffer.add(d['server_id'], d['task_name'], changed)
+                # this object may be older than the cached document, only what it changed is newer
+                current = None
+                if hasattr(self.bot, 'task_cache'):
+                    current = self.bot.task_cache.merge(d['server_id'], d['task_name'], changed)
+                current = current or dict(d, _id=self.id)
+            self._saved = self._snapshot(d)
+            scheduled = not changed.keys().isdisjoint(TaskRecord.SCHEDULE_PROJECTION)
+            if hasattr(self.bot, 'deadline_scheduler') and scheduled:
+                self.bot.deadline_scheduler.update(current)
+            if hasattr(self.bot, 'task_names'):
+                self.bot.task_names.add(d['server_id'], d['task_name'])
+            if changed.get('task_complete') and hasattr(self.bot, 'message_cache'):
+                # the messages of the task may have been pinned in other commands or reactions
+                self.bot.message_cache.unpin_task((d['server_id'], d['task_name']))
         except Exception as e:
             logging.error(traceback.format_exc())
             print(e)
@@ -138,12 +201,45 @@ class Task:
             'tasks_assigned': self.task_name,
         })
 
-    async def save_user_task_to_db(self):
-        if not self.user_ids:
-            return
-        for x in self.user_ids:
-            await self.bot.db.users.update_one({'user_id': str(x), 'server_id': str(self.server.id)},
-                                               {'$addToSet': await self.user_task_to_dict()}, upsert=True)
+    async def save_user_task_to_db(self, chunk_size=500, user_ids=None):
+        """Add the task to every assigned user (or the given ones) with unordered bulk upserts.
+        Returns {user_id: error message} for the users that could not be updated"""
+        failed = {}
+        user_ids = [str(x) for x in (self.user_ids if user_ids is None else user_ids)]
+        if not user_ids:
+            return failed
+        update = {'$addToSet': await self.user_task_to_dict()}
+        for i in range(0, user_ids.__len__(), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            try:
+                await self.bot.db.users.bulk_write([
+                    UpdateOne({'user_id': x, 'server_id': str(self.server.id)}, update, upsert=True) for x in chunk
+                ], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    failed[chunk[error['index']]] = error.get('errmsg')
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                failed.update({x: str(e) for x in chunk})
+        if failed:
+            logging.error(f'could not assign {self.task_name} to {failed.__len__()} users: {failed}')
+        return failed
+
+    async def save_assignees(self, channel):
+        """save_user_task_to_db, once more for the users that failed (e.g. concurrent upserts of the same user).
+        Users that still fail are dropped from the task and the channel is told about them"""
+        failed = await self.save_user_task_to_db()
+        if failed:
+            failed = await self.save_user_task_to_db(user_ids=list(failed))
+        if not failed:
+            return failed
+        self.user_ids = [x for x in self.user_ids if str(x) not in failed]
+        self.user_list = [m for m in self.user_list if m is None or str(m.id) not in failed]
+        mentions = ', '.join(f'<@{x}>' for x in failed)
+        await outbound(self.bot, 'send', channel.id,
+                       lambda: channel.send(f'**{self.task_name}** could not be assigned to {mentions}, '
+                                            f'please assign them again.'))
+        return failed
 
     async def is_complete(self, update_db=True):
         if self.server is None:
@@ -194,7 +290,8 @@ class Task:
         embed = discord.Embed(title="Task creation Wizard", description=text, color=SETTINGS.color)
         if stop:
             embed.set_footer(text="Type `stop` to cancel the wizard.")
-        return await message.edit(embed=embed)
+        return await outbound(self.bot, 'edit', message.channel.id, lambda: message.edit(embed=embed),
+                              coalesce_key=message.id)
 
     async def add_error(self, message, error, stop=True):
         text = ''
@@ -217,23 +314,8 @@ class Task:
             dt = self.deadline
             if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
                 dt = pytz.utc.localize(dt)
-            if isinstance(self.deadline_tz, float):
-                tz = possible_timezones(self.deadline_tz, common_only=True)
-                if not tz:
-                    tz = pytz.timezone('UTC')
-                else:
-                    # choose one valid timezone with the offset
-                    try:
-                        tz = pytz.timezone(tz[0])
-                    except UnknownTimeZoneError:
-                        tz = pytz.UTC
-            else:
-                try:
-                    tz = pytz.timezone(self.deadline_tz)
-                except UnknownTimeZoneError:
-                    tz = pytz.UTC
-
-            return dt.astimezone(tz)
+            # the stored zone name skips the offset lookup, older tasks only have the float offset
+            return dt.astimezone(resolve_timezone(self.deadline_tz_name, self.deadline_tz))
 
     async def get_deadline(self, string=False):
         if self.deadline == 0:
@@ -254,23 +336,19 @@ class Task:
         # sanitize input
         if string is None:
             raise InvalidInput
+        import regex  # deferred, only needed once a wizard runs
         string = regex.sub("\p{C}+", "", string)
         if set(string).issubset(set(' ')):
             raise InvalidInput
         return string
 
     async def user_role(self):
-        for role in self.task_role:
-            rol = get(self.server.roles, id=role)
-            for user in self.server.members:
-                if user.bot:
-                    continue
-                if rol in user.roles:
-                    if len(set(self.task_role)) != len(self.task_role):
-                        continue
-                    if user.id not in self.user_list:
-                        print("some", user.id)
-                        self.user_list.append(self.server.get_member(user.id))
+        assigned = {user.id for user in self.user_list if user is not None}
+        for role in set(self.task_role):
+            for user_id in self.bot.member_index.role_members(self.server, role):
+                if user_id not in assigned:
+                    assigned.add(user_id)
+                    self.user_list.append(self.server.get_member(user_id))
 
     async def set_task_description(self, ctx, args, force=None):
 
@@ -288,19 +366,10 @@ class Task:
                 raise InvalidInput
 
         async def check_users():
-            j = 0
             # check for the same user in array
-            print(args.__len__())
-            print(self.task_role.__len__())
             if len(set(users)) != len(users):
                 return -1
-            for member in ctx.guild.members:
-                if j >= args.__len__() - self.task_role.__len__():
-                    return j
-                if member.id == users[j]:
-                    j += 1
-                    print(f"{member.id} {member.display_name} found")
-            return j
+            return sum(1 for user_id in users if self.bot.member_index.has_member(ctx.guild, user_id))
 
         async def check_roles():
             z = 0
@@ -361,17 +430,10 @@ class Task:
     async def assign_task(self, force=None):
 
         async def check_users():
-            j = 0
             # check for the same user in array
             if len(set(self.user_ids)) != len(self.user_ids):
                 raise InputError
-            for member in self.ctx.guild.members:
-                if j >= self.user_ids.__len__():
-                    break
-                if member.id == int(self.user_ids[j]):
-                    j += 1
-                    print(f"{member.id} {member.display_name} found")
-            return j
+            return sum(1 for user_id in self.user_ids if self.bot.member_index.has_member(self.ctx.guild, int(user_id)))
 
         async def check_roles():
             z = 0
@@ -458,8 +520,7 @@ class Task:
             in_reply = self.sanitize_string(in_reply)
             if not in_reply:
                 raise InvalidInput
-            elif await self.bot.db.tasks.find_one(
-                    {'server_id': str(self.server.id), 'task_name': in_reply}) is not None:
+            elif await find_task(self.bot, self.server.id, in_reply) is not None:
                 raise DuplicateInput
             elif min_len <= in_reply.__len__() <= max_len and in_reply.split(" ").__len__() == 1:
                 return in_reply
@@ -501,7 +562,7 @@ class Task:
             elif in_reply == '0':
                 return 0
 
-            dt = dateparser.parse(in_reply)
+            dt = await parse_deadline(in_reply)
             if not isinstance(dt, datetime.datetime):
                 raise InvalidInput
 
@@ -524,6 +585,7 @@ class Task:
             self.date_created = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
             if self.deadline != 0:
                 self.deadline_tz = dt.utcoffset().total_seconds() / 3600
+                self.deadline_tz_name = getattr(dt.tzinfo, 'zone', None)
             return
         except InputError:
             pass
@@ -547,6 +609,7 @@ class Task:
                     await self.add_vaild(message, 'no deadline')
                 else:
                     self.deadline_tz = dt.utcoffset().total_seconds() / 3600
+                    self.deadline_tz_name = getattr(dt.tzinfo, 'zone', None)
                     self.date_created = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
                     await self.add_vaild(message, self.deadline.strftime('%d-%b-%Y %H:%M %Z'))
                 break
@@ -566,9 +629,7 @@ class Task:
         name = str(name)
         value = str(value)
 
-        nwidth = afm.string_width_height(unidecode(name))
-        vwidth = afm.string_width_height(unidecode(value))
-        w = max(nwidth[0], vwidth[0])
+        w = max(string_width(name), string_width(value))
 
         embed.add_field(name=name, value=value, inline=False if w > 12500 and self.cursor_pos % 2 == 1 else True)
         self.cursor_pos += 1
@@ -581,8 +642,34 @@ class Task:
 
         return embed
 
+    def __setattr__(self, name, value):
+        if name in Task.DISPLAYED_FIELDS:
+            object.__setattr__(self, '_version', None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def version(self):
+        """Changes whenever a displayed field changes, equal for tasks that render the same"""
+        if self._version is None:
+            self._version = tuple(getattr(self, field, None) for field in Task.DISPLAYED_FIELDS)
+        return self._version
+
+    def render_key(self):
+        return self.id, self.version
+
     async def generate_embed(self):
-        """Generate Discord Report"""
+        """Generate Discord Report, or reuse the rendering of the current version"""
+        # may complete the task, which is part of the version
+        await self.is_complete()
+        rendered = _RENDERED.get(self.render_key())
+        if rendered is not None:
+            _RENDERED.move_to_end(self.render_key())
+            return discord.Embed.from_dict(copy.deepcopy(rendered))
+        embed = await self.render_embed()
+        _remember(_RENDERED, self.render_key(), embed.to_dict(), _RENDERED_MAX)
+        return embed
+
+    async def render_embed(self):
         self.cursor_pos = 0
         embed = discord.Embed(title='', colour=SETTINGS.color)  # f'Status: {"Open" if self.is_open() else "Closed"}'
         embed.set_author(name=f' >> {self.task_name} ',
@@ -602,18 +689,34 @@ class Task:
 
         return embed
 
-    async def post_embed(self, destination):
-        msg = await destination.send(embed=await self.generate_embed())
-        if not await self.is_complete():
+    async def post_embed(self, destination, embed=None, priority=INTERACTIVE):
+        if embed is None:
+            embed = await self.generate_embed()
+        msg = await outbound(self.bot, 'send', destination.id, lambda: destination.send(embed=embed), priority,
+                             task=(str(self.server.id), self.task_name))
+        # generate_embed already ran is_complete, there is nothing left to save
+        complete = await self.is_complete(update_db=False)
+        if hasattr(self.bot, 'message_cache'):
+            self.bot.message_cache.put(msg.id, msg, pinned=not complete, task=(str(self.server.id), self.task_name))
+        if not complete:
             for i in self.get_preset_options():
-                await msg.add_reaction(i)
+                await outbound(self.bot, 'reaction', msg.channel.id, lambda: msg.add_reaction(i), priority)
             return msg
         else:
             return msg
 
+    @staticmethod
+    async def from_record(bot, record, ctx=None):
+        t = Task(bot, ctx, load=True)
+        await t.task_from_dict(record.to_doc())
+        return t
+
+    async def to_record(self):
+        return TaskRecord.from_doc(dict(await self.task_to_dict(), _id=self.id))
+
     @staticmethod
     async def load_from_db(bot, server_id, task_name, ctx=None, ):
-        query = await bot.db.tasks.find_one({'server_id': str(server_id), 'task_name': task_name})
+        query = await find_task(bot, server_id, task_name)
         if query is not None:
             t = Task(bot, ctx, load=True)
             await t.task_from_dict(query)
@@ -630,4 +733,9 @@ class Task:
             return False
 
     async def refresh(self, message):
-        await message.edit(embed=await self.generate_embed())
+        embed = await self.generate_embed()
+        # the message carries the embed it shows, edit() updates it
+        if message.embeds and _embed_content(message.embeds[0].to_dict()) == _embed_content(embed.to_dict()):
+            return
+        await outbound(self.bot, 'edit', message.channel.id, lambda: message.edit(embed=embed),
+                       coalesce_key=message.id)
@@ -46,3 +46,9 @@ class DateOutOfRange(InputError):
 class InvalidRoles(InputError):
     def __init__(self, roles):
         self.roles = roles
+
+
+class CollectionScan(RuntimeError):
+    def __init__(self, shapes):
+        self.shapes = shapes
+        super().__init__(f'collection scan for query shapes: {", ".join(shapes)}')
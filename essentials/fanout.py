@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+import discord
+
+from essentials.outbound import BULK
+
+logger = logging.getLogger('discord')
+
+
+class FanOutReport:
+    def __init__(self):
+        self.sent = {}  # recipient id -> message
+        self.failed = {}  # recipient id (or None for members that left) -> reason
+
+    def handled(self):
+        """Recipients that should not be retried: delivered, or with DMs closed"""
+        return list(self.sent) + [r for r, reason in self.failed.items() if r is not None and reason == 'forbidden']
+
+    def __str__(self):
+        return f'sent {self.sent.__len__()}, failed {self.failed.__len__()}'
+
+
+async def fan_out(task, recipients, limit=8, priority=BULK):
+    """Post the embed of a task to many recipients with at most `limit` deliveries in flight.
+    The embed is rendered once, one recipient failing (e.g. closed DMs) does not affect the others,
+    every failure ends up in the report."""
+    report = FanOutReport()
+    embed = await task.generate_embed()
+    semaphore = asyncio.Semaphore(limit)
+
+    async def deliver(recipient):
+        async with semaphore:
+            try:
+                report.sent[recipient.id] = await task.post_embed(recipient, embed=embed, priority=priority)
+            except discord.Forbidden:
+                report.failed[recipient.id] = 'forbidden'
+            except discord.HTTPException as e:
+                report.failed[recipient.id] = f'http {e.status}'
+
+    unique = {}
+    for recipient in recipients:
+        if recipient is None:
+            report.failed[None] = 'not a member'
+        else:
+            unique.setdefault(recipient.id, recipient)
+    results = await asyncio.gather(*(deliver(r) for r in unique.values()), return_exceptions=True)
+    for recipient_id, result in zip(unique, results):
+        if isinstance(result, BaseException):
+            # anything else going wrong for one recipient is reported as its failure
+            logger.error(f'task {task.task_name}: posting to {recipient_id} failed', exc_info=result)
+            report.failed[recipient_id] = f'error {type(result).__name__}'
+    logger.info(f'task {task.task_name}: {report}')
+    return report
+
+
+async def deliver(bot, task, kind, delivered=None):
+    """Post the task to the assignees that have not received this kind of notification yet (see bot.ledger).
+    delivered are the ledger keys that are known to exist, they are looked up if not given"""
+    ledger = bot.ledger
+    server_id = str(task.server.id)
+    keys = {m.id: ledger.key(server_id, task.task_name, m.id, kind) for m in task.user_list if m is not None}
+    if delivered is None:
+        delivered = await ledger.delivered(keys.values())
+    recipients = [m for m in task.user_list if m is not None and keys[m.id] not in delivered]
+    if not recipients:
+        return
+    report = await fan_out(task, recipients)
+    await ledger.record(server_id, task.task_name, kind, report.handled())
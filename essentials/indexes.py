@@ -0,0 +1,131 @@
+"""Indexes required by the queries of the bot and a check that every query shape uses one.
+
+The check can be run against a local mongod:
+    python -m essentials.indexes mongodb://localhost:27017
+"""
+import asyncio
+import datetime
+import logging
+import sys
+from types import SimpleNamespace
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from essentials.exceptions import CollectionScan
+from essentials.multi_server import TaskNameIndex
+from essentials.scheduler import pending_notifications_query
+from essentials.sharding import ShardOwnership
+
+logger = logging.getLogger('discord')
+
+# collection -> [(keys, options), ...]
+REQUIRED_INDEXES = {
+    'tasks': [
+        ([('server_id', ASCENDING), ('task_name', ASCENDING)], {'unique': True, 'name': 'server_task_name'}),
+        ([('task_complete', ASCENDING), ('deadline', ASCENDING)], {'name': 'complete_deadline'}),
+        # TaskNameIndex misses
+        ([('task_name', ASCENDING)], {'name': 'task_name'}),
+    ],
+    'users': [
+        ([('user_id', ASCENDING), ('server_id', ASCENDING)], {'unique': True, 'name': 'user_server'}),
+        ([('server_id', ASCENDING), ('tasks_assigned', ASCENDING)], {'name': 'server_tasks_assigned'}),
+    ],
+    'forwarded_reactions': [
+        ([('server_id', ASCENDING), ('created_at', ASCENDING)], {'name': 'server_created_at'}),
+        # not picked up within an hour, e.g. the owning process is down
+        ([('created_at', ASCENDING)], {'name': 'expire', 'expireAfterSeconds': 3600}),
+    ],
+    'bot_messages': [
+        ([('expires_at', ASCENDING), ('_id', ASCENDING)], {'name': 'expires_at'}),
+        ([('message_id', ASCENDING)], {'name': 'message_id'}),
+    ],
+}
+
+
+def query_shapes():
+    """Every filter the bot sends, with representative values: name -> (collection, filter[, sort]).
+    config is only read by _id or listed in full (one small document per server) and is left out.
+    Filters limited to the servers of a process come from ShardOwnership.query like in the bot."""
+    now = datetime.datetime.utcnow()
+    # one of the two guilds is on shard 0
+    owned = ShardOwnership([0], 2).query([SimpleNamespace(id=1 << 22), SimpleNamespace(id=2 << 22)])
+    return {
+        'tasks by server and name': ('tasks', {'server_id': '1', 'task_name': 'name'}),
+        'tasks by name': ('tasks', {'task_name': 'name'}),
+        'task name seed': ('tasks', {}, TaskNameIndex.SEED_SORT),
+        'task name seed of owned servers': ('tasks', owned, TaskNameIndex.SEED_SORT),
+        'open tasks': ('tasks', {'task_complete': False}),
+        'open tasks of owned servers': ('tasks', dict({'task_complete': False}, **owned)),
+        'pending deadline notifications': ('tasks', pending_notifications_query(now)),
+        'pending deadline notifications of owned servers': ('tasks', dict(pending_notifications_query(now),
+                                                                          **owned)),
+        'due tasks batch': ('tasks', {'$or': [{'server_id': '1', 'task_name': 'a'},
+                                              {'server_id': '2', 'task_name': 'b'}]}),
+        'open tasks of collected messages': ('tasks', {'$or': [{'server_id': '1', 'task_name': 'a'},
+                                                               {'server_id': '2', 'task_name': 'b'}],
+                                                       'task_complete': False}),
+        'users by task': ('users', {'tasks_assigned': 'name', 'server_id': '1'}),
+        'users of a task batch': ('users', {'server_id': {'$in': ['1', '2']}, 'tasks_assigned': {'$in': ['a', 'b']}}),
+        'user on servers': ('users', {'user_id': '1', 'server_id': {'$in': ['1', '2']}}),
+        'forwarded reactions': ('forwarded_reactions', owned, [('created_at', 1)]),
+        'forwarded reactions of a single process': ('forwarded_reactions', {}, [('created_at', 1)]),
+        'user by id': ('users', {'user_id': '1', 'server_id': '1'}),
+        'expired bot messages': ('bot_messages', {'expires_at': {'$lte': now}, '$or': [
+            {'expires_at': {'$gt': now}}, {'expires_at': now, '_id': {'$gt': 0}}]}),
+        'delivered notifications': ('notification_ledger', {'_id': {'$in': ['1:a:1:0', '1:a:2:0']}}),
+        'bot messages to retry': ('bot_messages', {'message_id': {'$in': [1, 2]}}),
+    }
+
+
+async def ensure_indexes(db):
+    """Create the required indexes, create_index is a no-op for indexes that already exist"""
+    for collection, indexes in REQUIRED_INDEXES.items():
+        for keys, options in indexes:
+            try:
+                await db[collection].create_index(keys, **options)
+            except OperationFailure as e:
+                # e.g. duplicates preventing a unique index, the bot still works without it
+                logger.error(f'could not create index {options["name"]} on {collection}: {e}')
+
+
+def _stages(plan):
+    yield plan.get('stage')
+    if 'queryPlan' in plan:
+        # slot based execution wraps the classic plan
+        yield from _stages(plan['queryPlan'])
+    if 'inputStage' in plan:
+        yield from _stages(plan['inputStage'])
+    for child in plan.get('inputStages', []):
+        yield from _stages(child)
+
+
+async def verify_query_plans(db):
+    """Raise CollectionScan if the winning plan of any query shape scans a whole collection"""
+    scans = []
+    for name, (collection, query, *sort) in query_shapes().items():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort[0])
+        explanation = await cursor.explain()
+        if 'COLLSCAN' in _stages(explanation['queryPlanner']['winningPlan']):
+            scans.append(name)
+    if scans:
+        raise CollectionScan(scans)
+
+
+async def _main(uri):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    db = AsyncIOMotorClient(uri).taskmaster
+    await ensure_indexes(db)
+    await verify_query_plans(db)
+    print(f'{query_shapes().__len__()} query shapes use an index')
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.get_event_loop().run_until_complete(_main(sys.argv[1] if sys.argv.__len__() > 1 else
+                                                          'mongodb://localhost:27017'))
+    except CollectionScan as e:
+        print(e)
+        sys.exit(1)
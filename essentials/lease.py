@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+import traceback
+import uuid
+
+import pytz
+from discord.ext import commands
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger('discord')
+
+
+def holder_id():
+    """Identifies this process as the holder of a lease"""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class MongoLease:
+    """Time limited lease on a named resource, stored in a mongo collection.
+
+    acquire() takes the lease if it is free, expired or already ours and renews it otherwise.
+    Every change of holder increments the fencing token; writes that must not come from a
+    former holder can be made conditional on it (see fence_filter)."""
+
+    def __init__(self, collection, name, holder, ttl=30.0):
+        self.collection = collection
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.token = None
+        self._valid_until = 0.0
+
+    @property
+    def held(self):
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    async def acquire(self):
+        """Take or renew the lease, returns whether it is held"""
+        started = time.monotonic()
+        utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        expires_at = utc_now + datetime.timedelta(seconds=self.ttl)
+        doc = None
+        if self.token is not None:
+            doc = await self.collection.find_one_and_update(
+                {'_id': self.name, 'holder': self.holder, 'token': self.token},
+                {'$set': {'expires_at': expires_at}}, return_document=ReturnDocument.AFTER)
+        if doc is None:
+            try:
+                doc = await self.collection.find_one_and_update(
+                    {'_id': self.name, 'expires_at': {'$lt': utc_now}},
+                    {'$set': {'holder': self.holder, 'expires_at': expires_at}, '$inc': {'token': 1}},
+                    upsert=True, return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # somebody else holds it
+                doc = None
+        if doc is None:
+            self.token = None
+            return False
+        if doc['token'] != self.token:
+            logger.info(f'acquired lease {self.name} with token {doc["token"]}')
+        self.token = doc['token']
+        # count from before the request so the lease is given up locally before it expires remotely
+        self._valid_until = started + self.ttl
+        return True
+
+    async def release(self):
+        if self.token is not None:
+            await self.collection.update_one({'_id': self.name, 'holder': self.holder, 'token': self.token},
+                                             {'$set': {'expires_at': datetime.datetime.utcnow()
+                                                      .replace(tzinfo=pytz.utc)}})
+        self.token = None
+
+    def fence_filter(self, field='fence'):
+        """Filter matching documents last written by this or an older holder"""
+        return {'$or': [{field: {'$lte': self.token}}, {field: {'$exists': False}}]}
+
+
+class Leadership(commands.Cog):
+    """Runs the background loops of the other cogs only while this process holds the lease.
+
+    Cogs take part by implementing start_background() and stop_background(). When the holder dies
+    another worker takes over within ttl + renew_interval seconds."""
+
+    def __init__(self, bot, ttl=30.0, renew_interval=10.0):
+        self.bot = bot
+        self.renew_interval = renew_interval
+        self.lease = MongoLease(bot.db.leases, f'background:{bot.shard_ownership.name}', holder_id(), ttl)
+        self.leading = False
+        bot.lease = self.lease
+        self._task = bot.loop.create_task(self.run())
+
+    def _background_cogs(self):
+        return [cog for cog in self.bot.cogs.values() if hasattr(cog, 'start_background')]
+
+    def _set_leading(self, leading):
+        if leading == self.leading:
+            return
+        self.leading = leading
+        for cog in self._background_cogs():
+            try:
+                cog.start_background() if leading else cog.stop_background()
+            except Exception:
+                logging.error(traceback.format_exc())
+        logger.info(f'{"started" if leading else "stopped"} background loops ({self.lease.name})')
+
+    async def run(self):
+        while not self.bot.is_closed():
+            try:
+                await self.lease.acquire()
+            except Exception:
+                logging.error(traceback.format_exc())
+            self._set_leading(self.lease.held)
+            await asyncio.sleep(self.renew_interval)
+
+    def cog_unload(self):
+        self._task.cancel()
+        self._set_leading(False)
+        self.bot.loop.create_task(self.lease.release())
+
+
+def setup(bot):
+    bot.add_cog(Leadership(bot))
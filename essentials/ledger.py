@@ -0,0 +1,37 @@
+import datetime
+
+import pytz
+from pymongo import UpdateOne
+
+# notification kinds, 0 is the embed posted when a task is created or assigned
+ASSIGNED = 0
+
+
+class NotificationLedger:
+    """Persistent record of the notifications that were delivered, keyed by task, user and kind"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def key(server_id, task_name, user_id, kind):
+        return f'{server_id}:{task_name}:{user_id}:{kind}'
+
+    async def delivered(self, keys):
+        """Return the subset of keys that is already in the ledger"""
+        keys = list(keys)
+        if not keys:
+            return set()
+        return {d['_id'] async for d in self.collection.find({'_id': {'$in': keys}}, {'_id': 1})}
+
+    async def record(self, server_id, task_name, kind, user_ids):
+        if not user_ids:
+            return
+        utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        await self.collection.bulk_write([
+            UpdateOne({'_id': self.key(server_id, task_name, user_id, kind)},
+                      {'$setOnInsert': {'server_id': server_id, 'task_name': task_name, 'user_id': user_id,
+                                        'kind': kind, 'date_delivered': utc_now}},
+                      upsert=True)
+            for user_id in user_ids
+        ], ordered=False)
@@ -0,0 +1,110 @@
+import logging
+
+from discord.ext import commands
+
+logger = logging.getLogger('discord')
+
+
+class GuildIndex:
+    """Member ids of one guild and, per role, the ids of its (non bot) members"""
+
+    def __init__(self, guild):
+        self.member_ids = set()
+        self.role_members = {}
+        for member in guild.members:
+            self.add(member)
+
+    def add(self, member):
+        self.member_ids.add(member.id)
+        if member.bot:
+            return
+        for role in member.roles:
+            self.role_members.setdefault(role.id, set()).add(member.id)
+
+    def remove(self, member):
+        self.member_ids.discard(member.id)
+        for role in member.roles:
+            members = self.role_members.get(role.id)
+            if members is not None:
+                members.discard(member.id)
+
+
+class MemberIndex(commands.Cog):
+    """Per guild role -> member index and user -> guilds index.
+    Built on first use and kept up to date from the gateway events"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._guilds = {}
+        self._user_guilds = {}
+        self._all_indexed = False
+        bot.member_index = self
+
+    def guild(self, guild):
+        index = self._guilds.get(guild.id)
+        if index is None:
+            index = self._guilds[guild.id] = GuildIndex(guild)
+            for user_id in index.member_ids:
+                self._user_guilds.setdefault(user_id, set()).add(guild.id)
+        return index
+
+    def guilds_of(self, user_id):
+        """Ids of the guilds the user shares with the bot"""
+        if not self._all_indexed:
+            for guild in self.bot.guilds:
+                self.guild(guild)
+            self._all_indexed = True
+        return self._user_guilds.get(user_id, set())
+
+    def role_members(self, guild, role_id):
+        return self.guild(guild).role_members.get(role_id, set())
+
+    def has_member(self, guild, user_id):
+        return user_id in self.guild(guild).member_ids
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if member.guild.id in self._guilds:
+            self._guilds[member.guild.id].add(member)
+            self._user_guilds.setdefault(member.id, set()).add(member.guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if member.guild.id in self._guilds:
+            self._guilds[member.guild.id].remove(member)
+            self._discard_user_guild(member.id, member.guild.id)
+
+    def _discard_user_guild(self, user_id, guild_id):
+        guild_ids = self._user_guilds.get(user_id)
+        if guild_ids is not None:
+            guild_ids.discard(guild_id)
+            if not guild_ids:
+                del self._user_guilds[user_id]
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles and after.guild.id in self._guilds:
+            index = self._guilds[after.guild.id]
+            index.remove(before)
+            index.add(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        if role.guild.id in self._guilds:
+            self._guilds[role.guild.id].role_members.pop(role.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        if self._all_indexed:
+            self.guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        index = self._guilds.pop(guild.id, None)
+        if index is not None:
+            for user_id in index.member_ids:
+                self._discard_user_guild(user_id, guild.id)
+
+
+def setup(bot):
+    bot.add_cog(MemberIndex(bot))
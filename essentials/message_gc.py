@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import logging
+import traceback
+
+import discord
+import pytz
+from discord.ext import commands
+from pymongo.errors import DuplicateKeyError
+
+from essentials.lease import MongoLease, holder_id
+from essentials.outbound import outbound, BULK
+
+logger = logging.getLogger('discord')
+
+# discord rejects bulk deletes of messages older than that
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+
+
+class MessageCollector(commands.Cog):
+    """Deletes the messages the bot posted once they are older than `retention`.
+
+    Every message sent through essentials.outbound is recorded in the bot_messages collection.
+    Messages showing a task are postponed by another `retention` as long as the task is open,
+    their reactions are how the assignees complete it.
+    The collector works through the expired records in (expires_at, _id) order, in paced batches,
+    and keeps its position in the config collection so a restart resumes where it stopped.
+    The records and the checkpoint are shared by all shards, so the collector has its own lease covering
+    all of them instead of the per shard lease of essentials.lease.Leadership."""
+
+    def __init__(self, bot, retention=datetime.timedelta(days=13), batch_size=50, pace=2.0, lease_ttl=300.0):
+        self.bot = bot
+        self.retention = retention
+        self.batch_size = batch_size
+        self.pace = pace
+        self.deleted = 0
+        self.lease = MongoLease(bot.db.leases, 'message_gc', holder_id(), lease_ttl)
+        bot.message_gc = self
+        self._task = bot.loop.create_task(self.collect())
+
+    def cog_unload(self):
+        self._task.cancel()
+        self.bot.loop.create_task(self.lease.release())
+
+    def record(self, message, task=None):
+        doc = {
+            'channel_id': message.channel.id,
+            'message_id': message.id,
+            'expires_at': datetime.datetime.utcnow().replace(tzinfo=pytz.utc) + self.retention
+        }
+        if task is not None:
+            doc['server_id'], doc['task_name'] = task
+        self.bot.loop.create_task(self.bot.db.bot_messages.insert_one(doc))
+
+    async def _delete(self, channel_id, message_ids):
+        """Returns the ids that should be retried later"""
+        channel = self.bot.get_channel(channel_id)
+        # retention is below the limit, but retried or delayed deletes can get past it
+        cutoff = datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE + datetime.timedelta(minutes=5)
+        recent = [i for i in message_ids if discord.utils.snowflake_time(i) > cutoff]
+        single = [i for i in message_ids if i not in recent]
+        if isinstance(channel, discord.TextChannel) and recent.__len__() > 1:
+            try:
+                # bulk delete needs manage messages, fall back to single deletes without it
+                await outbound(self.bot, 'delete', channel_id,
+                               lambda: channel.delete_messages([discord.Object(id=i) for i in recent]), BULK)
+            except discord.HTTPException:
+                single = message_ids
+        else:
+            single = message_ids
+        retry = []
+        for message_id in single:
+            try:
+                await outbound(self.bot, 'delete', channel_id,
+                               lambda: self.bot.http.delete_message(channel_id, message_id), BULK)
+            except (discord.NotFound, discord.Forbidden):
+                pass
+            except discord.HTTPException:
+                retry.append(message_id)
+        return retry
+
+    async def _checkpoint(self, update):
+        """Fenced write to the checkpoint, False if another process took the lease meanwhile"""
+        if not self.lease.held:
+            return False
+        update = dict(update, **{'$set': dict(update.get('$set', {}), fence=self.lease.token)})
+        try:
+            await self.bot.db.config.update_one(dict({'_id': 'message_gc'}, **self.lease.fence_filter()), update,
+                                                upsert=True)
+        except DuplicateKeyError:
+            logger.info('message collector lost the lease')
+            return False
+        return True
+
+    async def _open_tasks(self, batch):
+        """(server_id, task_name) of the open tasks the records of the batch show"""
+        tasks = {(doc['server_id'], doc['task_name']) for doc in batch if 'task_name' in doc}
+        if not tasks:
+            return set()
+        query = self.bot.db.tasks.find({'$or': [{'server_id': server_id, 'task_name': task_name}
+                                                for server_id, task_name in tasks], 'task_complete': False},
+                                       {'_id': 0, 'server_id': 1, 'task_name': 1})
+        return {(task['server_id'], task['task_name']) async for task in query}
+
+    async def collect_once(self):
+        """Handle one batch, returns the number of records handled"""
+        utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        checkpoint = await self.bot.db.config.find_one({'_id': 'message_gc'}) or {}
+        query = {'expires_at': {'$lte': utc_now}}
+        if 'expires_at' in checkpoint:
+            query['$or'] = [{'expires_at': {'$gt': checkpoint['expires_at']}},
+                            {'expires_at': checkpoint['expires_at'], '_id': {'$gt': checkpoint['last_id']}}]
+        batch = await self.bot.db.bot_messages.find(query).sort(
+            [('expires_at', 1), ('_id', 1)]).limit(self.batch_size).to_list(length=self.batch_size)
+        if not batch:
+            return 0
+
+        # a former holder must not delete anything, the new one may already be past this batch
+        if not await self._checkpoint({'$set': {'last_run': utc_now}}):
+            return 0
+        open_tasks = await self._open_tasks(batch)
+        keep = [doc['_id'] for doc in batch if (doc.get('server_id'), doc.get('task_name')) in open_tasks]
+        if keep:
+            await self.bot.db.bot_messages.update_many({'_id': {'$in': keep}},
+                                                       {'$set': {'expires_at': utc_now + self.retention}})
+        by_channel = {}
+        for doc in batch:
+            if doc['_id'] in keep:
+                continue
+            by_channel.setdefault(doc['channel_id'], []).append(doc['message_id'])
+        retry = []
+        for channel_id, message_ids in by_channel.items():
+            retry += await self._delete(channel_id, message_ids)
+
+        done = [doc['_id'] for doc in batch if doc['_id'] not in keep and doc['message_id'] not in retry]
+        await self.bot.db.bot_messages.delete_many({'_id': {'$in': done}})
+        if retry:
+            # try failed deletes again later, after the checkpoint
+            await self.bot.db.bot_messages.update_many({'message_id': {'$in': retry}},
+                                                       {'$set': {'expires_at': utc_now + datetime.timedelta(hours=1)}})
+        if not await self._checkpoint({'$set': {'expires_at': batch[-1]['expires_at'], 'last_id': batch[-1]['_id']},
+                                       '$inc': {'deleted': done.__len__()}}):
+            return 0
+        self.deleted += done.__len__()
+        return batch.__len__()
+
+    async def collect(self, interval=15 * 60):
+        while not self.bot.is_closed():
+            try:
+                # renewed before every batch, any process may collect once the holder is gone
+                while await self.lease.acquire() and await self.collect_once() == self.batch_size:
+                    await asyncio.sleep(self.pace)
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                print(e)
+            await asyncio.sleep(interval)
+
+
+def setup(bot):
+    bot.add_cog(MessageCollector(bot))
@@ -1,27 +1,139 @@
 import logging
+import time
+from collections import OrderedDict
+
 import discord
 
 logger = logging.getLogger('discord')
 
 
 class MessageCache:
-    def __init__(self, _bot):
+    """LRU cache of discord messages bounded by size and age.
+
+    Messages that belong to tasks which are still open can be pinned. Pinned messages are kept apart from
+    the LRU, bounded by max_pinned and pin_ttl since a task may be completed by another process.
+    unpin_task() hands all messages of a task back to the LRU once it is complete."""
+
+    def __init__(self, _bot, max_size=2000, ttl=6 * 3600, max_pinned=5000, pin_ttl=7 * 24 * 3600):
         self._bot = _bot
-        self._cache_dict = {}
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_pinned = max_pinned
+        self.pin_ttl = pin_ttl
+        self._cache_dict = OrderedDict()  # key -> (stored_at, message), least recently used first
+        self._pinned = OrderedDict()  # key -> (pinned_at, message), oldest pin first
+        self._task_keys = {}  # (server_id, task_name) -> {key, ...}
+        self._key_task = {}  # key -> (server_id, task_name)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def put(self, key, value: discord.Message):
-        self._cache_dict[key] = value
-        if self._cache_dict.__len__() % 5 == 0:
-            logger.info("cache size: " + str(self._cache_dict.__len__()))
+    def put(self, key, value: discord.Message, pinned=None, task=None):
+        """task is the (server_id, task_name) the message shows, needed for unpin_task()"""
+        if key in self._pinned:
+            self._pinned[key] = (self._pinned[key][0], value)
+        else:
+            self._cache_dict[key] = (time.monotonic(), value)
+            self._cache_dict.move_to_end(key)
+        if task is not None:
+            self._tag(key, task)
+        if pinned is not None:
+            self.pin(key, pinned)
+        self._evict()
+        if self.__len__() % 500 == 0:
+            logger.info("message cache: " + str(self.stats()))
 
     def get(self, key):
-        # Try to find it in this cache, then see if it is cached in the bots own message cache
-        message = self._cache_dict.get(key, None)
-        if message == None:
-            for m in self._bot._connection._messages:
-                if m.id == key:
-                    return m
+        entry = self._pinned.get(key)
+        if entry is not None:
+            if time.monotonic() - entry[0] <= self.pin_ttl:
+                self.hits += 1
+                return entry[1]
+            self._drop(self._pinned, key)
+            self.misses += 1
+            return None
+        entry = self._cache_dict.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored_at, message = entry
+        if time.monotonic() - stored_at > self.ttl:
+            self._drop(self._cache_dict, key)
+            self.misses += 1
+            return None
+        # sliding expiry keeps the dict ordered by age as well as by use
+        self._cache_dict[key] = (time.monotonic(), message)
+        self._cache_dict.move_to_end(key)
+        self.hits += 1
         return message
 
+    def pin(self, key, pinned=True, task=None):
+        """Keep (or stop keeping) a cached message regardless of its age, e.g. while its task is open"""
+        if task is not None and (key in self._cache_dict or key in self._pinned):
+            self._tag(key, task)
+        if pinned:
+            entry = self._cache_dict.pop(key, None)
+            if entry is not None:
+                self._pinned[key] = (time.monotonic(), entry[1])
+                self._evict_pinned()
+        else:
+            entry = self._pinned.pop(key, None)
+            if entry is not None:
+                self._cache_dict[key] = (time.monotonic(), entry[1])
+                self._evict()
+
+    def unpin_task(self, task):
+        """Unpin all messages of a (server_id, task_name), e.g. when it is completed"""
+        for key in list(self._task_keys.get(task, ())):
+            self.pin(key, False)
+
+    def _tag(self, key, task):
+        self._key_task[key] = task
+        self._task_keys.setdefault(task, set()).add(key)
+
+    def _drop(self, entries, key):
+        del entries[key]
+        self.evictions += 1
+        task = self._key_task.pop(key, None)
+        if task is not None:
+            keys = self._task_keys[task]
+            keys.discard(key)
+            if not keys:
+                del self._task_keys[task]
+
+    def _evict(self):
+        # only unpinned messages are in this dict, the walk stops at the first one that may stay
+        now = time.monotonic()
+        while self._cache_dict:
+            key, (stored_at, _) = next(iter(self._cache_dict.items()))
+            if self._cache_dict.__len__() <= self.max_size and now - stored_at <= self.ttl:
+                break
+            self._drop(self._cache_dict, key)
+
+    def _evict_pinned(self):
+        now = time.monotonic()
+        while self._pinned:
+            key, (pinned_at, _) = next(iter(self._pinned.items()))
+            if self._pinned.__len__() <= self.max_pinned and now - pinned_at <= self.pin_ttl:
+                break
+            self._drop(self._pinned, key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self.__len__(),
+            'pinned': self._pinned.__len__(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return self._cache_dict.__len__() + self._pinned.__len__()
+
     def clear(self):
-        self._cache_dict = {}
\ No newline at end of file
+        self._cache_dict = OrderedDict()
+        self._pinned = OrderedDict()
+        self._task_keys = {}
+        self._key_task = {}
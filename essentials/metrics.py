@@ -0,0 +1,371 @@
+"""Counters, gauges and histograms of the bot, served in the prometheus text format.
+
+Recording is a dict lookup for the labels and an add (histograms: a bisect over the buckets),
+benchmarks/bench_metrics.py measures it. Values that already exist elsewhere (cache sizes, queue depths)
+are gauges with a function, read only when the endpoint is scraped.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+from discord.ext import commands
+
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+# seconds
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# commands include the time people need to answer the wizard
+COMMAND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set_function(self, function):
+        """Read the value from function() when it is exported"""
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (buckets.__len__() + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """A metric name with its label names, labels() returns the child holding the values"""
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), **options):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.options = options
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if values.__len__() != self.labelnames.__len__():
+                raise ValueError(f'{self.name} has labels {self.labelnames}, got {values}')
+            child = self._children[values] = self._child()
+        return child
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield '', _format_labels(self.labelnames, values), child.value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def _child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            try:
+                value = child.get()
+            except Exception:
+                logger.exception(f'could not read {self.name}{values}')
+                continue
+            yield '', _format_labels(self.labelnames, values), value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def _child(self):
+        return _HistogramChild(self.options.get('buckets', FAST_BUCKETS))
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(child.buckets + ('+Inf',), child.counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.labelnames, values, f'le="{bound}"'), cumulative
+            yield '_sum', _format_labels(self.labelnames, values), child.sum
+            yield '_count', _format_labels(self.labelnames, values), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, documentation, labelnames, **options):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, documentation, labelnames, **options)
+        elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError(f'{name} is already registered differently')
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=FAST_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=tuple(buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.histogram('taskbot_command_seconds', 'Duration of the bot commands, wizards included',
+                                     ['command', 'status'], COMMAND_BUCKETS)
+MONGO_SECONDS = REGISTRY.histogram('taskbot_mongo_seconds', 'Duration of the mongodb operations, cursors until '
+                                                            'they are exhausted', ['collection', 'op'])
+MONGO_ERRORS = REGISTRY.counter('taskbot_mongo_errors_total', 'Failed mongodb operations', ['collection', 'op'])
+DISCORD_SECONDS = REGISTRY.histogram('taskbot_discord_seconds', 'Duration of the requests to discord',
+                                     ['route', 'status'])
+DISCORD_WAIT_SECONDS = REGISTRY.histogram('taskbot_discord_wait_seconds', 'Time requests wait for the rate limits',
+                                          ['priority'])
+SWEEP_SECONDS = REGISTRY.histogram('taskbot_sweep_seconds', 'Duration of the task sweeps', ['sweep'],
+                                   COMMAND_BUCKETS)
+SWEEP_TASKS = REGISTRY.gauge('taskbot_sweep_tasks', 'Tasks scanned by the last sweep', ['sweep'])
+DISPATCHED = REGISTRY.counter('taskbot_dispatched_notifications_total',
+                              'Deadline notifications the scheduler had due, and how many of them were sent', ['state'])
+LOOP_LAG_SECONDS = REGISTRY.histogram('taskbot_event_loop_lag_seconds', 'How late the event loop runs a timer')
+SLOW_STEPS = REGISTRY.counter('taskbot_slow_steps_total', 'Event loop steps over SETTINGS.slow_step_threshold',
+                              ['tag'])
+CACHE_SIZE = REGISTRY.gauge('taskbot_cache_size', 'Entries in the caches and queues of the bot', ['cache'])
+
+
+class _InstrumentedCursor:
+    __slots__ = ('_cursor', '_collection', '_iterator', '_elapsed')
+
+    def __init__(self, cursor, collection):
+        self._cursor = cursor
+        self._collection = collection
+        self._iterator = None
+        self._elapsed = 0.0
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name in ('sort', 'limit', 'skip', 'batch_size'):
+            def chained(*args, **kwargs):
+                attr(*args, **kwargs)
+                return self
+            return chained
+        return attr
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = self._cursor.__aiter__()
+        started = time.perf_counter()
+        try:
+            doc = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            MONGO_SECONDS.labels(self._collection, 'find').observe(self._elapsed + time.perf_counter() - started)
+            raise
+        except Exception:
+            MONGO_ERRORS.labels(self._collection, 'find').inc()
+            raise
+        self._elapsed += time.perf_counter() - started
+        return doc
+
+    async def to_list(self, length=None):
+        started = time.perf_counter()
+        try:
+            return await self._cursor.to_list(length=length)
+        except Exception:
+            MONGO_ERRORS.labels(self._collection, 'find').inc()
+            raise
+        finally:
+            MONGO_SECONDS.labels(self._collection, 'find').observe(time.perf_counter() - started)
+
+
+class InstrumentedCollection:
+    """Times the operations of a motor collection, anything else is passed through"""
+    OPERATIONS = ('find_one', 'find_one_and_update', 'find_one_and_delete', 'insert_one', 'insert_many', 'update_one', 'update_many',
+                  'delete_one', 'delete_many', 'bulk_write', 'count_documents', 'create_index')
+
+    def __init__(self, collection, name):
+        self._collection = collection
+        self._name = name
+
+    def find(self, *args, **kwargs):
+        return _InstrumentedCursor(self._collection.find(*args, **kwargs), self._name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in InstrumentedCollection.OPERATIONS:
+            return attr
+        histogram = MONGO_SECONDS.labels(self._name, name)
+
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await attr(*args, **kwargs)
+            except Exception:
+                MONGO_ERRORS.labels(self._name, name).inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        # later lookups find it without going through __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+class InstrumentedDatabase:
+    """Wraps a motor database so every operation of the bot on it is timed"""
+
+    def __init__(self, db):
+        self._db = db
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = InstrumentedCollection(self._db[name], name)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __repr__(self):
+        return f'InstrumentedDatabase({self._db!r})'
+
+
+class Metrics(commands.Cog):
+    """Serves REGISTRY on http://{SETTINGS.metrics_host}:{SETTINGS.metrics_port}/metrics,
+    times every command and samples the event loop lag"""
+
+    def __init__(self, bot, lag_interval=0.5):
+        self.bot = bot
+        self.lag_interval = lag_interval
+        self._runner = None
+        bot.before_invoke(self.before_command)
+        bot.after_invoke(self.after_command)
+        for cache, size in (('message_cache', lambda: bot.message_cache.__len__()),
+                            ('task_cache', lambda: bot.task_cache.__len__()),
+                            ('write_buffer', lambda: bot.write_buffer.stats()['pending']),
+                            ('deadline_scheduler', lambda: bot.deadline_scheduler.__len__()),
+                            ('outbound', lambda: sum(bot.outbound.stats()['depth'].values()))):
+            CACHE_SIZE.labels(cache).set_function(size)
+        self._tasks = [bot.loop.create_task(self.measure_lag())]
+        if SETTINGS.metrics_port:
+            self._tasks.append(bot.loop.create_task(self.serve(SETTINGS.metrics_host, SETTINGS.metrics_port)))
+
+    async def before_command(self, ctx):
+        ctx.metrics_started = time.perf_counter()
+
+    async def after_command(self, ctx):
+        # after_invoke also runs when the command raised
+        started = getattr(ctx, 'metrics_started', None)
+        if started is not None and ctx.command is not None:
+            COMMAND_SECONDS.labels(ctx.command.qualified_name, 'error' if ctx.command_failed else 'ok') \
+                .observe(time.perf_counter() - started)
+
+    async def measure_lag(self):
+        histogram = LOOP_LAG_SECONDS.labels()
+        loop = asyncio.get_event_loop()
+        while not self.bot.is_closed():
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            histogram.observe(max(0.0, loop.time() - expected))
+
+    async def serve(self, host, port):
+        from aiohttp import web  # aiohttp comes with discord.py, the server part is only needed here
+
+        async def metrics(request):
+            return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f'metrics on http://{host}:{port}/metrics')
+
+    def cog_unload(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._runner is not None:
+            self.bot.loop.create_task(self._runner.cleanup())
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
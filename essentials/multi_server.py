@@ -2,24 +2,49 @@ import asyncio
 
 import discord
 
+from essentials.outbound import outbound
 from essentials.settings import SETTINGS
 
 
+class TaskNameIndex:
+    """task_name -> ids of the servers that have a task with that name.
+
+    Seeded once from the owned servers and kept up to date by this process' saves. Names it doesn't
+    know, e.g. of tasks created by another worker, are looked up with the task_name index and added."""
+
+    # in the order of the server_task_name index, the seed reads the index instead of the documents
+    SEED_PROJECTION = {'_id': 0, 'server_id': 1, 'task_name': 1}
+    SEED_SORT = [('server_id', 1), ('task_name', 1)]
+
+    def __init__(self):
+        self._servers = {}
+
+    async def seed(self, db, query=None):
+        async for task in db.tasks.find(query or {}, TaskNameIndex.SEED_PROJECTION).sort(TaskNameIndex.SEED_SORT):
+            self.add(task['server_id'], task['task_name'])
+
+    def add(self, server_id, task_name):
+        self._servers.setdefault(task_name, set()).add(str(server_id))
+
+    async def servers(self, db, task_name, refresh=False):
+        """refresh also asks the database if the name is known, the local entry may be incomplete"""
+        servers = self._servers.get(task_name)
+        if servers is None or refresh:
+            async for task in db.tasks.find({'task_name': task_name}, {'_id': 0, 'server_id': 1}):
+                self.add(task['server_id'], task_name)
+            servers = self._servers.get(task_name, set())
+        return servers
+
+
 async def get_servers(bot, message, task_name=None):
     """Get best guess of relevant shared servers"""
     if message.guild is None:
-        list_of_shared_servers = []
-        for s in bot.guilds:
-            if message.author.id in [m.id for m in s.members]:
-                list_of_shared_servers.append(s)
+        list_of_shared_servers = [s for s in map(bot.get_guild, bot.member_index.guilds_of(message.author.id)) if s]
         if task_name is not None:
-            query = bot.db.tasks.find({'task_name': task_name})
-            if query is not None:
-                server_ids_with_task_name = [task['server_id'] async for task in query]
-                servers_with_short = [bot.get_guild(x) for x in server_ids_with_task_name]
-                shared_servers_with_short = list(set(servers_with_short).intersection(set(list_of_shared_servers)))
-                if shared_servers_with_short.__len__() >= 1:
-                    return shared_servers_with_short
+            server_ids_with_task_name = await bot.task_names.servers(bot.db, task_name)
+            shared_servers_with_short = [s for s in list_of_shared_servers if str(s.id) in server_ids_with_task_name]
+            if shared_servers_with_short.__len__() >= 1:
+                return shared_servers_with_short
 
         # do this if no shared server with short is found
         if list_of_shared_servers.__len__() == 0:
@@ -30,8 +55,22 @@ async def get_servers(bot, message, task_name=None):
         return [message.guild]
 
 
-async def ask_for_server(bot, message, short=None):
-    server_list = await get_servers(bot, message, short)
+async def candidate_server_ids(bot, user_id, task_name):
+    """Ids of the servers with a task of that name that the user is likely on, for DM reactions.
+    Works for servers of other processes as well: a user who isn't a member of one of the servers this process
+    sees counts if a task there was assigned to them. Falls back to all servers with the task name"""
+    server_ids = await bot.task_names.servers(bot.db, task_name, refresh=not bot.shard_ownership.owns_all)
+    member_of = {str(guild_id) for guild_id in bot.member_index.guilds_of(user_id)}
+    foreign = [s for s in server_ids if bot.get_guild(int(s)) is None]
+    if foreign:
+        member_of |= {u['server_id'] async for u in bot.db.users.find(
+            {'user_id': str(user_id), 'server_id': {'$in': foreign}}, {'_id': 0, 'server_id': 1})}
+    return sorted(s for s in server_ids if s in member_of) or sorted(server_ids)
+
+
+async def ask_for_server(bot, message, short=None, server_list=None):
+    if server_list is None:
+        server_list = await get_servers(bot, message, short)
     if server_list.__len__() == 0:
         if short == None:
             await bot.say(
@@ -49,7 +88,7 @@ async def ask_for_server(bot, message, short=None):
             text += f'\n**{i}** - {name}'
             i += 1
         embed = discord.Embed(title="Select your server", description=text, color=SETTINGS.color)
-        await message.channel.send(embed=embed)
+        await outbound(bot, 'send', message.channel.id, lambda: message.channel.send(embed=embed))
 
         valid_reply = False
         nr = 1
@@ -2,88 +2,290 @@ import asyncio
 import datetime
 import logging
 import time
+import traceback
 from asyncio import get_running_loop
-from time import strftime
 
 import discord
 import pytz
-from bson import ObjectId
-from discord.ext import tasks, commands
-from motor.motor_asyncio import AsyncIOMotorClient
+from discord.ext import commands
 
 from commands.task import Task, AZ_EMOJIS
-from essentials.multi_server import ask_for_server
+from essentials.fanout import deliver
+from essentials.ledger import ASSIGNED
+from essentials.metrics import DISPATCHED, SWEEP_SECONDS, SWEEP_TASKS
+from essentials.multi_server import ask_for_server, candidate_server_ids
+from essentials.outbound import outbound
+from essentials.records import TaskRecord
+from essentials.scheduler import DeadlineScheduler, pending_notifications_query
 from essentials.settings import SETTINGS
 
 
+# tasks created or changed by this process are scheduled when they are saved,
+# the reconcile pass picks up everything else (e.g. saved by other workers) that becomes due before the next pass
+RECONCILE_INTERVAL = datetime.timedelta(minutes=10)
+
+
+async def _records(query):
+    async for d in query:
+        yield TaskRecord.from_doc(d)
+
+
 class Notifications(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.ignore_next_removed_reaction = {}
         self.index = 0
-        self.user_auto_notifications.add_exception_type(KeyError)
-        self.user_auto_notifications.start()
-        get_running_loop().create_task(self.startup_notifications())
+        bot.deadline_scheduler = DeadlineScheduler()
+        self._background = []
+        self._forwarded = None
+        if not bot.shard_ownership.owns_all:
+            self._forwarded = bot.loop.create_task(self.forwarded_reactions())
+
+    def start_background(self):
+        """Started by essentials.lease while this process holds the lease"""
+        loop = get_running_loop()
+        self._background = [loop.create_task(self.reconcile_scheduler()),
+                            loop.create_task(self.user_auto_notifications()),
+                            loop.create_task(self.startup_notifications())]
+
+    def stop_background(self):
+        for task in self._background:
+            task.cancel()
+        self._background = []
+
+    def cog_unload(self):
+        self.stop_background()
+        if self._forwarded is not None:
+            self._forwarded.cancel()
 
-    async def notify_user(self, td, notify, utc_now):
+    def leading(self):
+        lease = getattr(self.bot, 'lease', None)
+        return lease is None or lease.held
+
+    async def load_assignees(self, tds):
+        """Resolve the user documents assigned to each of the task documents (or records) in one query.
+        Returns {(server_id, task_name): [user_doc, ...]}"""
+        assignees = {(td['server_id'], td['task_name']): [] for td in tds}
+        if not assignees:
+            return assignees
+        server_ids = list({server_id for server_id, _ in assignees})
+        task_names = list({task_name for _, task_name in assignees})
+        query = self.bot.db.users.find({'server_id': {'$in': server_ids}, 'tasks_assigned': {'$in': task_names}})
+        async for utd in query:
+            for task_name in utd['tasks_assigned']:
+                users = assignees.get((utd['server_id'], task_name))
+                if users is not None:
+                    users.append(utd)
+        return assignees
+
+    async def notify_user(self, record, notify, utc_now, assignees=None):
+        """Returns the record with the notification marked as sent"""
         # load task and update DB
-        t = Task(self.bot, load=True)
-        await t.task_from_dict(td)
+        t = await Task.from_record(self.bot, record)
         if notify == 7:
             t.days_7_notified = True
         elif notify == 1:
             t.day_1_notified = True
         t.date_notified = utc_now
-        userquery = self.bot.db.users.find({'tasks_assigned': td['task_name'], 'server_id': td['server_id']})
-        if userquery:
-            for limiter, utd in enumerate([tasks async for tasks in userquery]):
-                t.users_from_dict(utd)
+        if assignees is None:
+            assignees = (await self.load_assignees([record]))[record.key]
+        for utd in assignees:
+            t.users_from_dict(utd)
 
         await t.user_role()
         await t.save_task_to_db()
-        print(t.user_list)
-        if t.user_list:
-            for i in t.user_list:
-                await t.post_embed(i)
+        await deliver(self.bot, t, notify)
+        record = await t.to_record()
 
         # Check if TaskMaster is still present on the server
         if not t.server:
-            return
+            return record
         # Check if poll was activated and inform the sever if the poll is less than 2 hours past due
         # (activating old polls should only happen if the bot was offline for an extended period)
         if t.task_complete:
-            return
+            return record
+        return record
 
-    @tasks.loop(seconds=45)
     async def user_auto_notifications(self):
+        """Sleep until the next deadline notification is due and send it"""
+        scheduler = self.bot.deadline_scheduler
+        while not self.bot.is_closed():
+            await scheduler.wait()
+            if not self.leading():
+                # the lease was lost, essentials.lease restarts the loop once it is regained
+                return
+            await self.dispatch_due(datetime.datetime.utcnow().replace(tzinfo=pytz.utc))
+
+    async def dispatch_due(self, utc_now):
+        """Send the notifications the scheduler has due at utc_now, returns how many were sent"""
+        due = self.bot.deadline_scheduler.pop_due(utc_now)
+        if not due:
+            return 0
+        started = time.perf_counter()
+        sent = await self._dispatch(due, utc_now)
+        SWEEP_SECONDS.labels('dispatch').observe(time.perf_counter() - started)
+        SWEEP_TASKS.labels('dispatch').set(due.__len__())
+        DISPATCHED.labels('due').inc(due.__len__())
+        DISPATCHED.labels('sent').inc(sent)
+        return sent
+
+    async def _dispatch(self, due, utc_now):
+        try:
+            # the scheduler may be stale if the task was changed elsewhere, so check the stored state
+            query = self.bot.db.tasks.find({'$or': [{'server_id': server_id, 'task_name': task_name}
+                                                    for (server_id, task_name), _ in due]}, TaskRecord.PROJECTION)
+            records = {record.key: record async for record in _records(query)}
+            if hasattr(self.bot, 'write_buffer'):
+                # changes of this process that are not written yet
+                for key, record in records.items():
+                    pending = self.bot.write_buffer.pending(*key)
+                    if pending:
+                        records[key] = TaskRecord.from_doc(dict(record.to_doc(), **pending))
+            assignees = await self.load_assignees(records.values())
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            print(e)
+            return 0
+        sent = 0
+        for key, notify in due:
+            record = records.get(key)
+            if record is None or record.task_complete:
+                continue
+            if (notify == 1 and record.day_1_notified) or (notify == 7 and record.days_7_notified):
+                continue
+            try:
+                # the other kind of the same task must see this one as sent
+                records[key] = await self.notify_user(record, notify, utc_now, assignees[key])
+                sent += 1
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                print(e)
+        return sent
+
+    def owned_servers(self):
+        """Query filter for the servers on the shards of this process"""
+        return self.bot.shard_ownership.query(self.bot.guilds)
+
+    async def seed_scheduler(self):
+        """Load the deadline notifications due before the next reconcile pass into the scheduler"""
         if hasattr(self.bot, 'db'):
             utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            query = self.bot.db.tasks.find(
+                dict(pending_notifications_query(utc_now + RECONCILE_INTERVAL), **self.owned_servers()),
+                TaskRecord.SCHEDULE_PROJECTION).batch_size(500)
+            started = time.perf_counter()
+            scanned = 0
+            async for record in _records(query):
+                self.bot.deadline_scheduler.update(record)
+                scanned += 1
+            SWEEP_SECONDS.labels('reconcile').observe(time.perf_counter() - started)
+            SWEEP_TASKS.labels('reconcile').set(scanned)
+
+    async def reconcile_scheduler(self):
+        # picks up tasks that were written by something other than this process
+        while not self.bot.is_closed():
+            try:
+                await self.seed_scheduler()
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                print(e)
+            await asyncio.sleep(RECONCILE_INTERVAL.total_seconds())
+
+    def recipients(self, records, assignees):
+        """(record, server, assignee ids, kind) of the notifications the open task records should have sent"""
+        for record in records:
+            server = self.bot.get_guild(int(record.server_id))
+            if not server:
+                continue
+            user_ids = {int(utd['user_id']) for utd in assignees[record.key]}
+            for role in set(record.task_role or []):
+                user_ids |= self.bot.member_index.role_members(server, role)
+            # unsent deadline notifications are left to the scheduler, only finish the ones that were started
+            kinds = [ASSIGNED] + [kind for kind, flag in ((7, record.days_7_notified), (1, record.day_1_notified))
+                                  if flag]
+            for kind in kinds:
+                yield record, server, user_ids, kind
+
+    async def backfill_ledger(self, batch_size=500):
+        """Record the notifications of the open tasks as delivered, once per shard layout.
+        Tasks from before the ledger existed were posted already, catch_up would post them all again"""
+        marker = f'ledger_backfill:{self.bot.shard_ownership.name}'
+        if await self.bot.db.config.find_one({'_id': marker}):
+            return True
+        query = self.bot.db.tasks.find(dict({'task_complete': False}, **self.owned_servers()),
+                                       TaskRecord.PROJECTION).batch_size(batch_size)
+        batch = []
+        async for record in _records(query):
+            if not self.leading():
+                return False
+            batch.append(record)
+            if batch.__len__() == batch_size:
+                await self._backfill(batch)
+                batch = []
+        if batch:
+            await self._backfill(batch)
+        await self.bot.db.config.update_one(
+            {'_id': marker}, {'$set': {'date': datetime.datetime.utcnow().replace(tzinfo=pytz.utc)}}, upsert=True)
+        logging.info(f'notification ledger backfilled ({marker})')
+        return True
+
+    async def _backfill(self, records):
+        assignees = await self.load_assignees(records)
+        for record, _, user_ids, kind in self.recipients(records, assignees):
+            await self.bot.ledger.record(record.server_id, record.task_name, kind, list(user_ids))
+
+    async def catch_up(self, records, concurrency):
+        """Deliver what the ledger is missing for a batch of open task records"""
+        assignees = await self.load_assignees(records)
+        ledger = self.bot.ledger
+        pending = list(self.recipients(records, assignees))
+
+        delivered = await ledger.delivered(ledger.key(record.server_id, record.task_name, user_id, kind)
+                                           for record, _, user_ids, kind in pending for user_id in user_ids)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def deliver_missing(record, server, user_ids, kind):
+            missing = [user_id for user_id in user_ids
+                       if ledger.key(record.server_id, record.task_name, user_id, kind) not in delivered]
+            if not missing:
+                return
+            async with semaphore:
+                try:
+                    # only tasks with something to send become full Task objects
+                    t = await Task.from_record(self.bot, record)
+                    t.user_list = [server.get_member(user_id) for user_id in missing]
+                    await deliver(self.bot, t, kind, delivered)
+                except Exception as e:
+                    logging.error(traceback.format_exc())
+                    print(e)
 
-            # one day left notification
-            query = self.bot.db.tasks.find({'task_complete': False, 'deadline': {
-                '$lte': utc_now + datetime.timedelta(days=7)
-            }})
-            if query:
-                for limit, td in enumerate([tasks async for tasks in query]):
-
-                    if utc_now + datetime.timedelta(days=1) >= td['deadline'].replace(tzinfo=pytz.utc) >= td[
-                        'date_created'].replace(tzinfo=pytz.utc) + datetime.timedelta(days=1) and td[
-                        'day_1_notified'] == False:
-                        await self.notify_user(td, 1, utc_now)
-                    if utc_now + datetime.timedelta(days=7) >= td['deadline'].replace(tzinfo=pytz.utc) >= td[
-                        'date_created'].replace(tzinfo=pytz.utc) + datetime.timedelta(days=7) and td[
-                        'days_7_notified'] == False:
-                        await self.notify_user(td, 7, utc_now)
-
-    async def startup_notifications(self):
+        await asyncio.gather(*(deliver_missing(*p) for p in pending))
+
+    async def startup_notifications(self, batch_size=100, concurrency=4):
+        """Send the notifications that were missed while the bot was offline, streaming the open tasks"""
         if hasattr(self.bot, 'db'):
-            utc_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+            if not await self.backfill_ledger():
+                return
+            query = self.bot.db.tasks.find(dict({'task_complete': False}, **self.owned_servers()),
+                                           TaskRecord.PROJECTION).batch_size(batch_size)
+            started = time.perf_counter()
+            scanned = 0
+            batch = []
+            async for record in _records(query):
+                if not self.leading():
+                    return
+                batch.append(record)
+                scanned += 1
+                if batch.__len__() == batch_size:
+                    await self.catch_up(batch, concurrency)
+                    batch = []
+            if batch:
+                await self.catch_up(batch, concurrency)
+            SWEEP_SECONDS.labels('startup').observe(time.perf_counter() - started)
+            SWEEP_TASKS.labels('startup').set(scanned)
 
-            # one day left notification
-            query = self.bot.db.tasks.find({'task_complete': False})
-            if query:
-                for limit, td in enumerate([tasks async for tasks in query]):
-                    await self.notify_user(td, 0, utc_now)
+    async def remove_reaction(self, message, emoji, member):
+        await outbound(self.bot, 'reaction', message.channel.id, lambda: message.remove_reaction(emoji, member))
 
     @staticmethod
     def get_label(message: discord.Message):
@@ -97,6 +299,59 @@ class Notifications(commands.Cog):
                     label = label_full[3:]
         return label
 
+    async def dm_server_id(self, message, user_id, label):
+        """Id of the server of the task a DM reaction is for, or None.
+        Discord sends all DM events to shard 0, so the candidates come from the database
+        instead of the guilds of this process"""
+        server_ids = await candidate_server_ids(self.bot, user_id, label)
+        if server_ids.__len__() <= 1:
+            return server_ids[0] if server_ids else None
+        servers = [self.bot.get_guild(int(s)) or await self.bot.fetch_guild(int(s)) for s in server_ids]
+        server = await ask_for_server(self.bot, message, label, servers)
+        return str(server.id) if server else None
+
+    async def forward_reaction(self, server_id, label, channel_id, message_id, user_id, emoji):
+        """Leave a DM reaction for the process owning the server"""
+        await self.bot.db.forwarded_reactions.insert_one({
+            'server_id': server_id, 'task_name': label, 'channel_id': channel_id, 'message_id': message_id,
+            'user_id': user_id, 'emoji': emoji.name, 'created_at': datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        })
+
+    async def handle_forwarded_reactions(self):
+        """Apply the DM reactions other processes received for the servers of this one, returns how many"""
+        handled = 0
+        query = self.owned_servers()
+        while True:
+            # deleting while taking it makes sure only one process applies it
+            doc = await self.bot.db.forwarded_reactions.find_one_and_delete(query, sort=[('created_at', 1)])
+            if doc is None:
+                return handled
+            handled += 1
+            try:
+                server = self.bot.get_guild(int(doc['server_id']))
+                if server is None:
+                    continue
+                channel = self.bot.get_channel(doc['channel_id']) or await self.bot.fetch_channel(doc['channel_id'])
+                message = self.bot.message_cache.get(doc['message_id'])
+                if message is None:
+                    message = await channel.fetch_message(id=doc['message_id'])
+                    self.bot.message_cache.put(doc['message_id'], message)
+                user = self.bot.get_user(doc['user_id']) or await self.bot.fetch_user(doc['user_id'])
+                await self.apply_reaction(server, channel, message, doc['task_name'],
+                                          discord.PartialEmoji(name=doc['emoji']), doc['user_id'], user)
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                print(e)
+
+    async def forwarded_reactions(self, interval=1.0):
+        while not self.bot.is_closed():
+            try:
+                await self.handle_forwarded_reactions()
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                print(e)
+            await asyncio.sleep(interval)
+
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, data):
         # dont look at bot's own reactions
@@ -117,6 +372,7 @@ class Notifications(commands.Cog):
         channel = self.bot.get_channel(channel_id)
 
         if isinstance(channel, discord.TextChannel):
+            # guild events only reach the process of the guild's shard
             server = channel.guild
             user = server.get_member(user_id)
             message = self.bot.message_cache.get(message_id)
@@ -130,45 +386,51 @@ class Notifications(commands.Cog):
             label = self.get_label(message)
             if not label:
                 return
+            await self.apply_reaction(server, channel, message, label, emoji, user_id, user)
+            return
         elif isinstance(channel, discord.DMChannel):
             user = await self.bot.fetch_user(user_id)  # only do this once
-            message = self.bot.message_cache.get(message_id)
-            if message is None:
-                message = await channel.fetch_message(id=message_id)
-                self.bot.message_cache.put(message_id, message)
-            label = self.get_label(message)
-            if not label:
-                return
-            server = await ask_for_server(self.bot, message, label)
         elif not channel:
             # discord rapidly closes dm channels by design
             # put private channels back into the bots cache and try again
             user = await self.bot.fetch_user(user_id)  # only do this once
             await user.create_dm()
             channel = self.bot.get_channel(channel_id)
-            message = self.bot.message_cache.get(message_id)
-            if message is None:
-                message = await channel.fetch_message(id=message_id)
-                self.bot.message_cache.put(message_id, message)
-            label = self.get_label(message)
-            if not label:
-                return
-            server = await ask_for_server(self.bot, message, label)
         else:
             return
 
+        message = self.bot.message_cache.get(message_id)
+        if message is None:
+            message = await channel.fetch_message(id=message_id)
+            self.bot.message_cache.put(message_id, message)
+        label = self.get_label(message)
+        if not label:
+            return
+        server_id = await self.dm_server_id(message, user_id, label)
+        if server_id is None:
+            return
+        if not self.bot.shard_ownership.owns(server_id):
+            await self.forward_reaction(server_id, label, channel.id, message.id, user_id, emoji)
+            return
+        server = self.bot.get_guild(int(server_id))
+        if server is not None:
+            await self.apply_reaction(server, channel, message, label, emoji, user_id, user)
+
+    async def apply_reaction(self, server, channel, message, label, emoji, user_id, user):
         t = await Task.load_from_db(self.bot, server.id, label)
         if not isinstance(t, Task):
             return
+        self.bot.message_cache.pin(message.id, not t.task_complete, task=(str(server.id), label))
         member = server.get_member(user_id)
 
         if emoji.name == '✅':
             if not isinstance(channel, discord.DMChannel):
                 self.ignore_next_removed_reaction[str(message.id) + str(emoji)] = user_id
-                self.bot.loop.create_task(message.remove_reaction(emoji, member))  # remove reaction
+                self.bot.loop.create_task(self.remove_reaction(message, emoji, member))
 
             t.task_complete = True
             await t.save_task_to_db()
+            self.bot.message_cache.pin(message.id, not t.task_complete, task=(str(server.id), label))
             await t.refresh(message)
             print(emoji)
             # # sending file
@@ -182,18 +444,20 @@ class Notifications(commands.Cog):
         if emoji.name == '❌':
             if not isinstance(channel, discord.DMChannel):
                 self.ignore_next_removed_reaction[str(message.id) + str(emoji)] = user_id
-                self.bot.loop.create_task(message.remove_reaction(emoji, member))  # remove reaction
+                self.bot.loop.create_task(self.remove_reaction(message, emoji, member))
 
             t.task_complete = False
             await t.save_task_to_db()
+            self.bot.message_cache.pin(message.id, not t.task_complete, task=(str(server.id), label))
             await t.refresh(message)
         if emoji.name == '⏩':
             print("hello")
 
         if not t.has_required_role(member):
-            await message.remove_reaction(emoji, user)
-            await member.send(f'You are not allowed to vote in this poll. Only users with '
-                              f'at least one of these roles can vote:\n{", ".join(t.roles)}')
+            await self.remove_reaction(message, emoji, user)
+            await outbound(self.bot, 'send', member.id,
+                           lambda: member.send(f'You are not allowed to vote in this poll. Only users with '
+                                               f'at least one of these roles can vote:\n{", ".join(t.roles)}'))
             return
 
     @commands.Cog.listener()
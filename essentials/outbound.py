@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import discord
+
+from essentials.metrics import DISCORD_SECONDS, DISCORD_WAIT_SECONDS
+
+logger = logging.getLogger('discord')
+
+# priorities, lower goes first
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+# route -> (tokens per second, burst), buckets are kept per route and channel like discord does
+ROUTE_LIMITS = {
+    'send': (1.0, 5),
+    'edit': (1.0, 5),
+    'reaction': (4.0, 1),
+    'delete': (5.0, 5),
+}
+GLOBAL_LIMIT = (40.0, 40)
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served by priority, then in arrival order"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority=INTERACTIVE):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._schedule()
+        await future
+
+    def _schedule(self):
+        if self._timer is None and self._waiters:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._timer = asyncio.get_event_loop().call_later(delay, self._pump)
+
+    def _pump(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # the waiter was cancelled
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        self._schedule()
+
+    @property
+    def idle(self):
+        self._refill()
+        return not self._waiters and self._tokens >= self.capacity
+
+
+async def _timed(route, factory):
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        return await factory()
+    except discord.HTTPException as e:
+        status = str(e.status)
+        raise
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        DISCORD_SECONDS.labels(route, status).observe(time.perf_counter() - started)
+
+
+class _Pending:
+    __slots__ = ('factory', 'future')
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class OutboundQueue:
+    """Single path for all requests the bot sends to discord.
+
+    Requests wait for a token of their (route, channel) bucket and of the global bucket,
+    interactive requests are served before bulk ones. Requests sharing a coalesce_key
+    (edits of the same message) that are still waiting are merged, only the newest one is sent."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._global = TokenBucket(*GLOBAL_LIMIT)
+        self._coalescing = {}
+        self.depth = {INTERACTIVE: 0, BULK: 0}
+        self.sent = {INTERACTIVE: 0, BULK: 0}
+        self.wait_total = {INTERACTIVE: 0.0, BULK: 0.0}
+        self.wait_max = {INTERACTIVE: 0.0, BULK: 0.0}
+        self.coalesced = 0
+
+    def _bucket(self, route, channel_id):
+        key = (route, channel_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if self._buckets.__len__() > 10000:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.idle}
+            bucket = self._buckets[key] = TokenBucket(*ROUTE_LIMITS[route])
+        return bucket
+
+    async def request(self, route, channel_id, factory, priority=INTERACTIVE, coalesce_key=None):
+        """Send factory() once the rate limits allow it and return its result"""
+        if coalesce_key is not None:
+            pending = self._coalescing.get(coalesce_key)
+            if pending is not None:
+                # newest edit wins, everyone waiting gets its result
+                pending.factory = factory
+                self.coalesced += 1
+                return await asyncio.shield(pending.future)
+        pending = _Pending(factory)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = pending
+
+        queued_at = time.monotonic()
+        self.depth[priority] += 1
+        try:
+            await self._bucket(route, channel_id).acquire(priority)
+            await self._global.acquire(priority)
+        except BaseException:
+            # don't leave merged edits waiting on a request that will never be sent
+            pending.future.cancel()
+            raise
+        finally:
+            self.depth[priority] -= 1
+            if coalesce_key is not None and self._coalescing.get(coalesce_key) is pending:
+                del self._coalescing[coalesce_key]
+        waited = time.monotonic() - queued_at
+        self.sent[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+        DISCORD_WAIT_SECONDS.labels(PRIORITY_NAMES[priority]).observe(waited)
+
+        try:
+            result = await _timed(route, pending.factory)
+        except Exception as e:
+            pending.future.set_exception(e)
+            # nobody else may be waiting, don't warn about an unretrieved exception
+            pending.future.exception()
+            raise
+        pending.future.set_result(result)
+        return result
+
+    def stats(self):
+        return {
+            'depth': dict(self.depth),
+            'sent': dict(self.sent),
+            'wait_avg': {p: self.wait_total[p] / self.sent[p] if self.sent[p] else 0.0 for p in self.sent},
+            'wait_max': dict(self.wait_max),
+            'coalesced': self.coalesced,
+        }
+
+
+async def outbound(bot, route, channel_id, factory, priority=INTERACTIVE, coalesce_key=None, task=None):
+    """Route a discord call through the bot's OutboundQueue (or call it directly if there is none).
+    task is the (server_id, task_name) a sent message shows, it is kept while the task is open"""
+    queue = getattr(bot, 'outbound', None)
+    if queue is None:
+        result = await _timed(route, factory)
+    else:
+        result = await queue.request(route, channel_id, factory, priority, coalesce_key)
+    if route == 'send' and isinstance(result, discord.Message) and hasattr(bot, 'message_gc'):
+        bot.message_gc.record(result, task)
+    return result
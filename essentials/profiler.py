@@ -0,0 +1,162 @@
+import asyncio
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import discord
+from discord.ext import commands
+
+from essentials.metrics import SLOW_STEPS
+from essentials.outbound import outbound
+from essentials.settings import SETTINGS
+
+logger = logging.getLogger('discord')
+
+MAX_PROFILE_SECONDS = 300
+
+
+def _label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _stack(frame):
+    """Frames from the outermost to frame"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _tag(frames):
+    """The command or event the frames are running for, found in the locals of discord.py's dispatch frames"""
+    tag = None
+    for frame in frames:
+        name = frame.f_code.co_name
+        if name == '_run_event':
+            tag = f'event {frame.f_locals.get("event_name")}'
+        elif name == 'invoke':
+            command = getattr(frame.f_locals.get('ctx'), 'command', None)
+            if command is not None:
+                tag = f'command {command.qualified_name}'
+    return tag
+
+
+def sample(seconds, interval=0.005):
+    """Sample the stacks of all other threads for `seconds`.
+    Returns Counter of collapsed stacks ('thread;outer frame;...;inner frame') -> samples"""
+    stacks = Counter()
+    me = threading.get_ident()
+    names = {}
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stacks[';'.join([names.get(ident, str(ident))] + [_label(f) for f in _stack(frame)])] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class SlowStepDetector:
+    """Logs event loop steps that run longer than `threshold` seconds.
+
+    A heartbeat coroutine stamps the time every `interval`, a watchdog thread notices when the stamp gets
+    too old, takes the stack of the loop thread while it is still stuck and logs it once the loop moves on."""
+
+    def __init__(self, loop, threshold=0.25, interval=0.05):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.detected = 0
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._heartbeat = loop.create_task(self.heartbeat())
+        self._watchdog = threading.Thread(target=self.watch, name='slow-step-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _inspect(self):
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return None, []
+        frames = _stack(frame)
+        tag = _tag(frames)
+        if tag is None:
+            task = asyncio.current_task(self.loop)
+            tag = f'task {task.get_name() if hasattr(task, "get_name") else task}' if task else 'callback'
+        return tag, [_label(f) for f in frames]
+
+    def watch(self):
+        stalled = None  # (beat, tag, stack) of the step that is running too long
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            if stalled is not None and beat != stalled[0]:
+                blocked = beat - stalled[0] - self.interval
+                SLOW_STEPS.labels(stalled[1]).inc()
+                logger.warning(f'event loop blocked for {blocked:.3f} s by {stalled[1]}, stack:\n    '
+                               + '\n    '.join(stalled[2][-15:]))
+                stalled = None
+            if stalled is None and time.monotonic() - beat > self.interval + self.threshold:
+                self.detected += 1
+                stalled = (beat,) + self._inspect()
+
+    def stop(self):
+        self._stopped.set()
+        self._heartbeat.cancel()
+
+
+def is_owner(ctx):
+    return ctx.author.id == SETTINGS.owner_id
+
+
+class Profiler(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self._profiling = False
+        self.detector = SlowStepDetector(bot.loop, SETTINGS.slow_step_threshold)
+
+    def cog_unload(self):
+        self.detector.stop()
+
+    @commands.command()
+    @commands.check(is_owner)
+    async def profile(self, ctx, seconds: int = 30):
+        """Sample all threads for some seconds and DM the collapsed stacks (flamegraph.pl / speedscope input)"""
+        if self._profiling:
+            await outbound(self.bot, 'send', ctx.channel.id, lambda: ctx.send('A profile is already running.'))
+            return
+        seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+        self._profiling = True
+        try:
+            stacks = await self.bot.loop.run_in_executor(None, sample, seconds)
+        finally:
+            self._profiling = False
+
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(stacks.values())
+        top = '\n'.join(f'{count * 100 / total:5.1f}% {leaf}' for leaf, count in leaves.most_common(10))
+        data = '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common()).encode('utf-8')
+        file = discord.File(io.BytesIO(data), filename=f'profile-{int(time.time())}.collapsed')
+        await outbound(self.bot, 'send', ctx.author.id,
+                       lambda: ctx.author.send(f'{total} samples over {seconds} s, most frequent frames:\n'
+                                               f'```{top[:1800]}```', file=file))
+
+
+def setup(bot):
+    bot.add_cog(Profiler(bot))
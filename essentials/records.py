@@ -0,0 +1,44 @@
+class TaskRecord:
+    """Compact, read-mostly view of a task document for scans like the notification sweep.
+
+    Task is the interactive object of the wizard (bot, ctx, wizard messages, guild objects),
+    convert explicitly with Task.from_record / Task.to_record when one is needed.
+    Supports get() and [] like the documents it is built from."""
+
+    FIELDS = ('_id', 'server_id', 'task_name', 'task_author', 'task_description', 'task_role', 'date_created',
+              'deadline', 'deadline_tz', 'deadline_tz_name', 'task_complete', 'days_7_notified', 'day_1_notified',
+              'date_notified')
+    __slots__ = FIELDS
+
+    # everything a record holds
+    PROJECTION = {field: 1 for field in FIELDS}
+    # only what the deadline scheduler looks at
+    SCHEDULE_PROJECTION = {field: 1 for field in ('server_id', 'task_name', 'date_created', 'deadline',
+                                                  'task_complete', 'days_7_notified', 'day_1_notified')}
+
+    def __init__(self, **fields):
+        for field in TaskRecord.FIELDS:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_doc(cls, d):
+        return cls(**d)
+
+    def to_doc(self):
+        return {field: getattr(self, field) for field in TaskRecord.FIELDS}
+
+    @property
+    def key(self):
+        return self.server_id, self.task_name
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in TaskRecord.FIELDS else None
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        if field not in TaskRecord.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f'TaskRecord({self.server_id!r}, {self.task_name!r})'
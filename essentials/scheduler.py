@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+
+import pytz
+
+# notification kind -> how long before the deadline it fires
+NOTIFICATION_WINDOWS = {
+    7: datetime.timedelta(days=7),
+    1: datetime.timedelta(days=1),
+}
+
+
+def as_utc(dt):
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        return dt.replace(tzinfo=pytz.utc)
+    return dt.astimezone(pytz.utc)
+
+
+def pending_notifications_query(until):
+    """Open tasks with a deadline notification that is not sent yet and fires before `until`.
+    Mirrors DeadlineScheduler.fire_times so the filtering happens in the database"""
+    windows = []
+    for kind, flag in ((7, 'days_7_notified'), (1, 'day_1_notified')):
+        window_ms = int(NOTIFICATION_WINDOWS[kind].total_seconds() * 1000)
+        windows.append({flag: False, '$expr': {'$and': [
+            {'$gte': ['$deadline', {'$add': ['$date_created', window_ms]}]},
+            {'$lte': ['$deadline', until + NOTIFICATION_WINDOWS[kind]]},
+        ]}})
+    return {
+        'task_complete': False,
+        'deadline': {'$lte': until + max(NOTIFICATION_WINDOWS.values())},
+        '$or': windows
+    }
+
+
+class DeadlineScheduler:
+    """Min-heap of the exact times at which deadline notifications are due.
+
+    Tasks are keyed by (server_id, task_name) and described by the dicts produced by
+    Task.task_to_dict (or task documents / TaskRecords), so updating a task simply replaces its entries.
+    Outdated heap entries are dropped lazily when they reach the top."""
+
+    def __init__(self):
+        self._heap = []  # (fire_at, seq, key, kind)
+        self._entries = {}  # key -> {kind: fire_at}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def fire_times(d):
+        if d.get('task_complete') or not isinstance(d.get('deadline'), datetime.datetime) \
+                or not isinstance(d.get('date_created'), datetime.datetime):
+            return {}
+        deadline = as_utc(d['deadline'])
+        date_created = as_utc(d['date_created'])
+        times = {}
+        if not d.get('days_7_notified') and deadline >= date_created + NOTIFICATION_WINDOWS[7]:
+            times[7] = deadline - NOTIFICATION_WINDOWS[7]
+        if not d.get('day_1_notified') and deadline >= date_created + NOTIFICATION_WINDOWS[1]:
+            times[1] = deadline - NOTIFICATION_WINDOWS[1]
+        return times
+
+    def update(self, d):
+        key = (str(d['server_id']), d['task_name'])
+        times = self.fire_times(d)
+        if times == self._entries.get(key, {}):
+            return
+        if not times:
+            self._entries.pop(key, None)
+            return
+        self._entries[key] = times
+        earliest = self.next_fire_at()
+        for kind, fire_at in times.items():
+            heapq.heappush(self._heap, (fire_at, next(self._seq), key, kind))
+        if earliest is None or min(times.values()) < earliest:
+            self._wakeup.set()
+
+    def discard(self, server_id, task_name):
+        self._entries.pop((str(server_id), task_name), None)
+
+    def _is_current(self, entry):
+        fire_at, _, key, kind = entry
+        return self._entries.get(key, {}).get(kind) == fire_at
+
+    def _prune(self):
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def next_fire_at(self):
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, utc_now):
+        """Remove and return [((server_id, task_name), kind), ...] for everything due at utc_now"""
+        due = []
+        while self.next_fire_at() is not None and self._heap[0][0] <= utc_now:
+            _, _, key, kind = heapq.heappop(self._heap)
+            times = self._entries[key]
+            del times[kind]
+            if not times:
+                del self._entries[key]
+            due.append((key, kind))
+        return due
+
+    async def wait(self, max_sleep=3600):
+        """Sleep until the next entry is due or an earlier one gets scheduled"""
+        self._wakeup.clear()
+        fire_at = self.next_fire_at()
+        if fire_at is None:
+            timeout = max_sleep
+        else:
+            timeout = (fire_at - datetime.datetime.utcnow().replace(tzinfo=pytz.utc)).total_seconds()
+            timeout = min(max(timeout, 0), max_sleep)
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __len__(self):
+        return self._entries.__len__()
@@ -12,6 +12,14 @@ class Settings:
         self.log_errors = True
         self.invite_link = \
             'link_here'
+        # set both to run only some of the shards in this process, e.g. [0, 1] of 4
+        self.shard_count = None
+        self.shard_ids = None
+        # prometheus metrics on http://metrics_host:metrics_port/metrics, None to not serve them
+        self.metrics_host = '127.0.0.1'
+        self.metrics_port = 9464
+        # event loop steps running longer than this many seconds are logged by essentials.profiler
+        self.slow_step_threshold = 0.25
 
         self.load_secrets()
 
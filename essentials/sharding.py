@@ -0,0 +1,34 @@
+class ShardOwnership:
+    """Which servers this process is responsible for.
+
+    Each process runs the shards in shard_ids out of shard_count and owns exactly the guilds on them,
+    its sweeps, caches and reaction handling are limited to those. shard_ids None means all shards."""
+
+    def __init__(self, shard_ids=None, shard_count=None):
+        self.shard_count = shard_count or 1
+        self.shard_ids = set(shard_ids) if shard_ids is not None else set(range(self.shard_count))
+
+    @staticmethod
+    def shard_of(server_id, shard_count):
+        # discord's sharding formula
+        return (int(server_id) >> 22) % shard_count
+
+    @property
+    def owns_all(self):
+        return self.shard_ids >= set(range(self.shard_count))
+
+    def owns(self, server_id):
+        return self.owns_all or self.shard_of(server_id, self.shard_count) in self.shard_ids
+
+    def owned_server_ids(self, guilds):
+        return [str(g.id) for g in guilds if self.owns(g.id)]
+
+    def query(self, guilds, field='server_id'):
+        """Filter limiting a query to the owned servers, empty if this process owns everything"""
+        if self.owns_all:
+            return {}
+        return {field: {'$in': self.owned_server_ids(guilds)}}
+
+    @property
+    def name(self):
+        return ','.join(str(i) for i in sorted(self.shard_ids)) + f'/{self.shard_count}'
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('discord')
+
+
+class TaskCache:
+    """Write-through LRU cache of task documents keyed by (server_id, task_name), bounded by size and age.
+    Task.save_task_to_db keeps it up to date, writes made outside of this process need invalidate()"""
+
+    def __init__(self, max_size=5000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._docs = OrderedDict()  # key -> (stored_at, doc)
+        self.loading = {}  # key -> future of the database read, shared by concurrent misses
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _copy(doc):
+        # Task objects append to the lists of the document they were loaded from
+        return {k: list(v) if isinstance(v, list) else v for k, v in doc.items()}
+
+    def get(self, server_id, task_name):
+        key = (str(server_id), task_name)
+        entry = self._docs.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._docs[key]
+            self.misses += 1
+            return None
+        self._docs.move_to_end(key)
+        self.hits += 1
+        return self._copy(entry[1])
+
+    def put(self, doc, replace=True):
+        """replace=False keeps a document that is already cached, e.g. written while doc was being read"""
+        key = (str(doc['server_id']), doc['task_name'])
+        if not replace and key in self._docs:
+            return
+        self._docs[key] = (time.monotonic(), self._copy(doc))
+        self._docs.move_to_end(key)
+        while self._docs.__len__() > self.max_size:
+            self._docs.popitem(last=False)
+
+    def merge(self, server_id, task_name, fields):
+        """Apply changed fields to the cached document, returns a copy of it or None if the task isn't cached"""
+        entry = self._docs.get((str(server_id), task_name))
+        if entry is None:
+            return None
+        entry[1].update(self._copy(fields))
+        return self._copy(entry[1])
+
+    def invalidate(self, server_id=None, task_name=None):
+        """Drop one task, or everything if no task is given"""
+        if server_id is None:
+            self._docs.clear()
+        else:
+            self._docs.pop((str(server_id), task_name), None)
+
+    def stats(self):
+        return {'size': self._docs.__len__(), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    def __len__(self):
+        return self._docs.__len__()
+
+
+async def _load_task(bot, server_id, task_name):
+    doc = await bot.db.tasks.find_one({'server_id': str(server_id), 'task_name': task_name})
+    if doc is not None and hasattr(bot, 'write_buffer'):
+        doc.update(bot.write_buffer.pending(server_id, task_name))
+    return doc
+
+
+async def find_task(bot, server_id, task_name):
+    """Task document from the cache, or from the database with the buffered changes applied (and then cached).
+    Concurrent misses for the same task share one database read"""
+    cache = getattr(bot, 'task_cache', None)
+    if cache is None:
+        return await _load_task(bot, server_id, task_name)
+    doc = cache.get(server_id, task_name)
+    if doc is not None:
+        return doc
+    key = (str(server_id), task_name)
+    loading = cache.loading.get(key)
+    if loading is None:
+        loading = cache.loading[key] = asyncio.ensure_future(_load_task(bot, server_id, task_name))
+        loading.add_done_callback(lambda _: cache.loading.pop(key, None))
+    else:
+        cache.coalesced += 1
+    # one waiter being cancelled must not cancel the read for the others
+    doc = await asyncio.shield(loading)
+    if doc is None:
+        return None
+    cache.put(doc, replace=False)
+    return cache._copy(doc)
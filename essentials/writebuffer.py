@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import traceback
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger('discord')
+
+
+class TaskWriteBuffer:
+    """Write-behind buffer for changed task fields.
+
+    Changes to the same task within `window` seconds are merged into a single $set and all pending
+    tasks are written with unordered bulk_write batches. flush() writes everything immediately.
+    Reads that decide something (e.g. whether a notification is sent) apply pending() to what they read."""
+
+    def __init__(self, bot, window=0.5, batch_size=500):
+        self.bot = bot
+        self.window = window
+        self.batch_size = batch_size
+        self._pending = {}  # (server_id, task_name) -> {field: value}
+        self._flushing = {}  # the same, for the changes being written right now
+        self._flusher = None
+        self.requested = 0
+        self.merged = 0
+        self.written = 0
+        self.flushes = 0
+
+    def add(self, server_id, task_name, fields):
+        key = (str(server_id), task_name)
+        self.requested += 1
+        if key in self._pending:
+            self._pending[key].update(fields)
+            self.merged += 1
+        else:
+            self._pending[key] = dict(fields)
+        if self._flusher is None:
+            self._flusher = asyncio.get_event_loop().create_task(self._flush_later())
+
+    def pending(self, server_id, task_name):
+        """Changed fields of the task that may not be in the database yet"""
+        key = (str(server_id), task_name)
+        return {**self._flushing.get(key, {}), **self._pending.get(key, {})}
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        self.flushes += 1
+        for key, fields in pending.items():
+            self._flushing[key] = {**self._flushing.get(key, {}), **fields}
+        try:
+            await self._write(list(pending.items()))
+        finally:
+            for key in pending:
+                self._flushing.pop(key, None)
+
+    async def _write(self, items):
+        for i in range(0, items.__len__(), self.batch_size):
+            batch = items[i:i + self.batch_size]
+            try:
+                await self.bot.db.tasks.bulk_write([
+                    UpdateOne({'server_id': server_id, 'task_name': task_name}, {'$set': fields}, upsert=True)
+                    for (server_id, task_name), fields in batch
+                ], ordered=False)
+                self.written += batch.__len__()
+            except BulkWriteError as e:
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                self.written += batch.__len__() - failed.__len__()
+                logging.error(f'{failed.__len__()} task writes failed: {e.details.get("writeErrors")}')
+            except Exception as e:
+                # keep the changes for the next flush, newer values win
+                logging.error(traceback.format_exc())
+                for key, fields in batch:
+                    self._pending[key] = {**fields, **self._pending.get(key, {})}
+                if self._flusher is None:
+                    self._flusher = asyncio.get_event_loop().create_task(self._flush_later())
+
+    def stats(self):
+        return {'pending': self._pending.__len__(), 'requested': self.requested, 'merged': self.merged,
+                'written': self.written, 'flushes': self.flushes}
@@ -1,39 +1,77 @@
 import json
 import logging
 
-import aiohttp
-from motor.motor_asyncio import AsyncIOMotorClient
+from utils.startup_profile import phase, report
+
+with phase('import aiohttp/discord'):
+    import aiohttp
+    from discord.ext import commands, tasks
+
+with phase('import commands'):
+    from commands.assign import *
+    from commands.task import *
+
+with phase('import essentials'):
+    from essentials.fanout import fan_out
+    from essentials.indexes import ensure_indexes
+    from essentials.ledger import NotificationLedger, ASSIGNED
+    from essentials.messagecache import MessageCache
+    from essentials.metrics import InstrumentedDatabase
+    from essentials.multi_server import ask_for_server, TaskNameIndex
+    from essentials.outbound import OutboundQueue
+    from essentials.sharding import ShardOwnership
+    from essentials.taskcache import TaskCache
+    from essentials.writebuffer import TaskWriteBuffer
 
-from commands import *
+intents = discord.Intents.default()
+intents.members = True
 
-from discord.ext import commands, tasks
 
-from commands import *
-from commands.assign import *
-from commands.task import *
-from essentials.messagecache import MessageCache
-from essentials.multi_server import ask_for_server
 
-intents = discord.Intents.default()
-intents.members = True
+class TaskBot(commands.AutoShardedBot):
+    async def close(self):
+        # write out the buffered task changes before the connection goes away
+        if hasattr(self, 'db'):
+            await self.write_buffer.flush()
+        await super().close()
+
 
-client = commands.Bot(command_prefix="/task ", intents=intents)
+client = TaskBot(command_prefix="/task ", intents=intents,
+                 shard_count=SETTINGS.shard_count, shard_ids=SETTINGS.shard_ids)
+client.shard_ownership = ShardOwnership(SETTINGS.shard_ids, SETTINGS.shard_count)
 mydbcursor = None
 logger = logging.getLogger('discord')
 
-extensions = ['essentials.notifications']
+# essentials.lease goes last, it starts the background loops of the others
+extensions = ['essentials.member_index', 'essentials.notifications', 'essentials.message_gc', 'essentials.metrics',
+              'essentials.profiler', 'essentials.lease']
 
 client.message_cache = MessageCache(client)
+client.outbound = OutboundQueue()
+client.task_cache = TaskCache()
+client.write_buffer = TaskWriteBuffer(client)
 
 
 @client.event
 async def on_ready():
     # mongodb below
 
-    mongo = AsyncIOMotorClient(SETTINGS.mongo_db)
-    client.db = mongo.taskmaster
-    client.session = aiohttp.ClientSession()
+    with phase('connect mongodb'):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo = AsyncIOMotorClient(SETTINGS.mongo_db)
+        # times every operation for essentials.metrics
+        client.db = InstrumentedDatabase(mongo.taskmaster)
+        client.session = aiohttp.ClientSession()
     print(client.db)
+    with phase('ensure indexes'):
+        await ensure_indexes(client.db)
+    client.ledger = NotificationLedger(client.db.notification_ledger)
+    if not hasattr(client, 'task_names'):
+        # on_ready runs again after every reconnect, the index is kept up to date from then on
+        with phase('load task names'):
+            task_names = TaskNameIndex()
+            await task_names.seed(client.db, client.shard_ownership.query(client.guilds))
+            client.task_names = task_names
     try:
         db_server_ids = [entry['_id'] async for entry in client.db.config.find({}, {})]
         for server in client.guilds:
@@ -44,24 +82,21 @@ async def on_ready():
                     {'$set': {'admin_role': 'taskadmin', 'user_role': 'taskuser'}},
                     upsert=True
                 )
-        for members in server.members:
-            print(members)
-            if members.bot:
-                continue
-            async for message in members.history():
-                if message.author == client.user:
-                    print("trying to delete")
-                    await message.delete()
 
     except Exception as e:
         print(e)
 
 
-    with open('utils/emoji-compact.json', encoding='utf-8') as emojson:
-        client.emoji_dict = json.load(emojson)
+    with phase('load emoji'):
+        with open('utils/emoji-compact.json', encoding='utf-8') as emojson:
+            client.emoji_dict = json.load(emojson)
 
     for ext in extensions:
-        client.load_extension(ext)
+        # on_ready runs again after every reconnect
+        if ext not in client.extensions:
+            with phase(f'load {ext}'):
+                client.load_extension(ext)
+    logger.info('startup profile:\n' + report())
 
 
 @client.command()
@@ -76,10 +111,10 @@ async def new(ctx, *args):
         await taskk.set_deadline(ctx)
         taskk.task_notifications = 1
         await taskk.save_task_to_db()
-        await taskk.save_user_task_to_db()
+        await taskk.save_assignees(ctx.channel)
         await taskk.clean_up(ctx.channel)
-        for i in taskk.user_list:
-            await taskk.post_embed(i)
+        report = await fan_out(taskk, taskk.user_list)
+        await client.ledger.record(str(taskk.server.id), taskk.task_name, ASSIGNED, report.handled())
     except StopWizard:
         print("wizard stopped")
         await taskk.clean_up(ctx.channel)
@@ -0,0 +1,136 @@
+"""Deadline parsing for the task wizard.
+
+The inputs people actually type (the wizard's own examples: `in 2 days`, `next week CET`, ISO dates,
+`13.11.2019 9pm EST`) are handled by a few regular expressions. Everything else goes to one dateparser
+instance restricted to LANGUAGES, which runs in a worker thread so it cannot block the event loop.
+Like dateparser, results without a timezone are naive local time.
+"""
+import asyncio
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+LANGUAGES = ['en']
+
+# abbreviation -> utc offset in hours
+TIMEZONE_ABBREVIATIONS = {
+    'UTC': 0, 'GMT': 0, 'WET': 0, 'WEST': 1, 'BST': 1, 'CET': 1, 'CEST': 2, 'EET': 2, 'EEST': 3,
+    'EST': -5, 'EDT': -4, 'CST': -6, 'CDT': -5, 'MST': -7, 'MDT': -6, 'PST': -8, 'PDT': -7,
+}
+UNITS = {
+    'minute': datetime.timedelta(minutes=1), 'min': datetime.timedelta(minutes=1),
+    'hour': datetime.timedelta(hours=1), 'h': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1), 'week': datetime.timedelta(weeks=1),
+}
+
+_TZ = r'(?:\s+(?P<tz>[a-z]{3,4}))?$'
+_TIME = r'(?:\s+(?:at\s+)?(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<ampm>am|pm)?)?'
+_RELATIVE = re.compile(r'^in\s+(?P<n>\d+)\s*(?P<unit>minute|min|hour|h|day|week)s?' + _TZ)
+_NAMED = re.compile(r'^(?P<name>tomorrow|next week)' + _TZ)
+_ISO = re.compile(r'^(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})'
+                  r'(?:[t\s](?P<hour>\d{1,2}):(?P<minute>\d{2}))?' + _TZ)
+_DOTTED = re.compile(r'^(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4})' + _TIME + _TZ)
+# anything that makes the result depend on the current time
+_NOW_DEPENDENT = re.compile(r'\b(in|ago|next|last|this|now|today|tonight|tomorrow|yesterday|minutes?|hours?|'
+                            r'days?|weeks?|months?|years?|mon|tue|wed|thu|fri|sat|sun)[a-z]*\b')
+_YEAR = re.compile(r'\b\d{4}\b')
+# without a day ("december 2030") dateparser takes the current one
+_MONTH_NAME = re.compile(r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\b')
+# one or two digits that are not part of a time ("10:30", "5pm", "17h")
+_DAY_OR_MONTH = re.compile(r'(?<![\d:])\d{1,2}(?:st|nd|rd|th)?(?![\d:])(?!\s*(?:am|pm|h\b))')
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dateparser')
+_parser = None
+
+
+def _timezone(abbreviation):
+    if abbreviation is None:
+        return None
+    offset = TIMEZONE_ABBREVIATIONS.get(abbreviation.upper())
+    if offset is None:
+        raise KeyError(abbreviation)
+    return datetime.timezone(datetime.timedelta(hours=offset), abbreviation.upper())
+
+
+def _now(tz):
+    return datetime.datetime.now(tz) if tz else datetime.datetime.now()
+
+
+def _absolute(year, month, day, hour=None, minute=None, ampm=None, tz=None):
+    hour = int(hour or 0)
+    if ampm == 'pm' and hour < 12:
+        hour += 12
+    elif ampm == 'am' and hour == 12:
+        hour = 0
+    return datetime.datetime(int(year), int(month), int(day), hour, int(minute or 0), tzinfo=tz)
+
+
+def parse_fast(text):
+    """Parse the common formats, returns None if the text is not one of them"""
+    text = ' '.join(text.lower().split())
+    try:
+        m = _RELATIVE.match(text)
+        if m:
+            return _now(_timezone(m.group('tz'))) + int(m.group('n')) * UNITS[m.group('unit')]
+        m = _NAMED.match(text)
+        if m:
+            days = 1 if m.group('name') == 'tomorrow' else 7
+            return _now(_timezone(m.group('tz'))) + datetime.timedelta(days=days)
+        m = _ISO.match(text)
+        if m:
+            return _absolute(m.group('year'), m.group('month'), m.group('day'), m.group('hour'), m.group('minute'),
+                             tz=_timezone(m.group('tz')))
+        m = _DOTTED.match(text)
+        # day.month is only unambiguous if the day can't be a month, leave the rest to dateparser
+        if m and int(m.group('day')) > 12:
+            if m.group('hour') and not m.group('minute') and not m.group('ampm'):
+                return None
+            return _absolute(m.group('year'), m.group('month'), m.group('day'), m.group('hour'), m.group('minute'),
+                             m.group('ampm'), _timezone(m.group('tz')))
+    except (KeyError, ValueError):
+        # unknown timezone or out of range values
+        return None
+    return None
+
+
+def _get_parser():
+    global _parser
+    if _parser is None:
+        import dateparser
+        _parser = dateparser.DateDataParser(languages=LANGUAGES)
+    return _parser
+
+
+def _parse_slow(text):
+    return _get_parser().get_date_data(text)['date_obj']
+
+
+@lru_cache(maxsize=1024)
+def _parse_slow_cached(text):
+    return _parse_slow(text)
+
+
+def is_time_independent(text):
+    """Whether the text names an exact date, so its parse can be cached"""
+    text = text.lower()
+    if _YEAR.search(text) is None or _NOW_DEPENDENT.search(text) is not None:
+        return False
+    numbers = _DAY_OR_MONTH.findall(text).__len__()
+    # a month name and the day, or the day and the month as numbers
+    return numbers >= (1 if _MONTH_NAME.search(text) else 2)
+
+
+@lru_cache(maxsize=1024)
+def _parse_fast_cached(text):
+    return parse_fast(text)
+
+
+async def parse_deadline(text):
+    """Parse a deadline typed by a user, returns a datetime or None"""
+    independent = is_time_independent(text)
+    dt = _parse_fast_cached(text) if independent else parse_fast(text)
+    if dt is not None:
+        return dt
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_executor, _parse_slow_cached if independent else _parse_slow, text)
@@ -1,4 +1,5 @@
 import argparse
+from functools import lru_cache
 
 import pytz
 import datetime as dt
@@ -30,10 +31,25 @@ class CustomFormatter(argparse.RawTextHelpFormatter):
             return ', '.join(parts)
 
 
-def possible_timezones(tz_offset, common_only=True):
-    # pick one of the timezone collections
-    timezones = pytz.common_timezones if common_only else pytz.all_timezones
+# offset (timedelta) -> [tz_name, ...], built once per process and per collection
+_OFFSET_INDEX = {}
+
+
+def _offset_index(common_only=True):
+    index = _OFFSET_INDEX.get(common_only)
+    if index is None:
+        timezones = pytz.common_timezones if common_only else pytz.all_timezones
+        null_delta = dt.timedelta(0, 0)
+        index = {}
+        for tz_name in timezones:
+            tz = pytz.timezone(tz_name)
+            non_dst_offset = getattr(tz, '_transition_info', [[null_delta]])[-1]
+            index.setdefault(non_dst_offset[0], []).append(tz_name)
+        _OFFSET_INDEX[common_only] = index
+    return index
 
+
+def possible_timezones(tz_offset, common_only=True):
     # convert the float hours offset to a timedelta
     offset_days, offset_seconds = 0, int(tz_offset * 3600)
     if offset_seconds < 0:
@@ -41,13 +57,29 @@ def possible_timezones(tz_offset, common_only=True):
         offset_seconds += 24 * 3600
     desired_delta = dt.timedelta(offset_days, offset_seconds)
 
-    # Loop through the timezones and find any with matching offsets
-    null_delta = dt.timedelta(0, 0)
-    results = []
-    for tz_name in timezones:
-        tz = pytz.timezone(tz_name)
-        non_dst_offset = getattr(tz, '_transition_info', [[null_delta]])[-1]
-        if desired_delta == non_dst_offset[0]:
-            results.append(tz_name)
+    # look up the timezones with a matching (non dst) offset
+    return list(_offset_index(common_only).get(desired_delta, []))
+
 
-    return results
\ No newline at end of file
+@lru_cache(maxsize=512)
+def resolve_timezone(tz_name=None, tz_offset=None):
+    """Return a pytz timezone for an IANA name or, failing that, a float hours offset. Falls back to UTC."""
+    if tz_name:
+        try:
+            return pytz.timezone(tz_name)
+        except pytz.UnknownTimeZoneError:
+            pass
+    if isinstance(tz_offset, float):
+        tz = possible_timezones(tz_offset, common_only=True)
+        if tz:
+            # choose one valid timezone with the offset
+            try:
+                return pytz.timezone(tz[0])
+            except pytz.UnknownTimeZoneError:
+                pass
+    elif isinstance(tz_offset, str):
+        try:
+            return pytz.timezone(tz_offset)
+        except pytz.UnknownTimeZoneError:
+            pass
+    return pytz.UTC
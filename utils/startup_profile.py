@@ -0,0 +1,78 @@
+"""Startup timing of the bot, broken down by import and init phase.
+
+main.py wraps its imports and on_ready steps in phase(); the report is logged once the bot is ready.
+The import budget can be checked without a discord connection:
+    python -m utils.startup_profile --budget 1.5
+"""
+import argparse
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+_started = time.perf_counter()
+_phases = []
+
+# modules that must only be imported on first use
+DEFERRED_MODULES = ['dateparser', 'regex', 'unidecode', 'matplotlib', 'motor']
+ENTRY_MODULES = ['commands.task', 'commands.assign', 'essentials.member_index', 'essentials.notifications',
+                 'essentials.message_gc', 'essentials.metrics', 'essentials.profiler',
+                 'essentials.lease']
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def report():
+    lines = [f'{name:<28}{duration * 1000:9.1f} ms' for name, duration in _phases]
+    lines.append(f'{"total since start":<28}{(time.perf_counter() - _started) * 1000:9.1f} ms')
+    return '\n'.join(lines)
+
+
+def measure_imports():
+    """Import the entry modules in a fresh interpreter.
+    Returns (seconds, [(cumulative us, module), ...] sorted descending, deferred modules that got imported)"""
+    code = (f'import sys, time; t = time.perf_counter(); import {", ".join(ENTRY_MODULES)}; '
+            f'print(time.perf_counter() - t); '
+            f'print(",".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.splitlines()[-2:]
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time:   self [us] |  cumulative | imported package
+        m = re.match(r'import time:\s+\d+\s+\|\s+(\d+)\s+\|(\s*)(\S+)', line)
+        if m and m.group(2) == ' ':
+            modules.append((int(m.group(1)), m.group(3)))
+    return float(seconds), sorted(modules, reverse=True), [m for m in loaded.split(',') if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the bot modules.')
+    parser.add_argument('--budget', type=float, default=1.5, help='seconds allowed for importing the entry modules')
+    parser.add_argument('--top', type=int, default=15, help='number of top level imports to show')
+    args = parser.parse_args()
+
+    seconds, modules, loaded = measure_imports()
+    for cumulative, name in modules[:args.top]:
+        print(f'{name:<40}{cumulative / 1000:9.1f} ms')
+    print(f'{"total":<40}{seconds * 1000:9.1f} ms (budget {args.budget * 1000:.0f} ms)')
+    failed = False
+    if loaded:
+        print(f'imported eagerly, should be deferred: {", ".join(loaded)}')
+        failed = True
+    if seconds > args.budget:
+        print('import time budget exceeded')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()